@@ -0,0 +1,98 @@
+"""Conversion between SONATA and NWB. peakmem_* benchmarks track the peak RSS of the process. The SONATA files of
+every size are written once per run by setup_cache, the largest with about 1 GB of float32 report data."""
+import os
+import shutil
+import tempfile
+
+from ndx_simulation_output.testing import write_ecp, write_report, write_spikes
+
+# n_cells, n_compartments (on average per cell), n_times
+SIZES = {
+    '10MB': (100, 10, 2500),
+    '100MB': (1000, 10, 2500),
+    '1GB': (1000, 100, 2500),
+}
+
+
+def write_sonata(data_dir, n_cells, n_compartments, n_times):
+    write_report(os.path.join(data_dir, 'membrane_potential.h5'), n_cells, n_compartments, n_times,
+                 dtype='float32', offset=-65., vary_compartments=True, chunked=True, block_size=250)
+    write_spikes(os.path.join(data_dir, 'spikes.h5'), n_cells, n_spikes=10 * n_cells, duration=n_times * .1)
+    write_ecp(os.path.join(data_dir, 'ecp.h5'), os.path.join(data_dir, 'electrodes.csv'), n_channels=32,
+              n_times=n_times)
+
+
+class SonataToNWB:
+    params = list(SIZES)
+    param_names = ['size']
+    timeout = 600
+
+    def setup_cache(self):
+        data_dirs = {size: os.path.abspath(tempfile.mkdtemp(dir='.')) for size in SIZES}
+        for size, data_dir in data_dirs.items():
+            write_sonata(data_dir, *SIZES[size])
+        return data_dirs
+
+    setup_cache.timeout = 1800
+
+    def setup(self, data_dirs, size):
+        self.data_dir = data_dirs[size]
+        self.tmp_dir = tempfile.mkdtemp()
+        self.nwb_fpath = os.path.join(self.tmp_dir, 'converted.nwb')
+
+    def teardown(self, *args):
+        shutil.rmtree(self.tmp_dir)
+
+    def time_sonata2nwb(self, *args):
+        from ndx_simulation_output.io.from_sonata import sonata2nwb
+        sonata2nwb(self.data_dir, self.nwb_fpath)
+
+    def time_sonata2nwb_streamed(self, *args):
+        from ndx_simulation_output.io.from_sonata import sonata2nwb
+        sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=0.1)
+
+    def peakmem_sonata2nwb(self, *args):
+        from ndx_simulation_output.io.from_sonata import sonata2nwb
+        sonata2nwb(self.data_dir, self.nwb_fpath)
+
+    def peakmem_sonata2nwb_streamed(self, *args):
+        from ndx_simulation_output.io.from_sonata import sonata2nwb
+        sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=0.1)
+
+
+class NWBToSonata:
+    params = list(SIZES)
+    param_names = ['size']
+    timeout = 600
+
+    def setup_cache(self):
+        from ndx_simulation_output.io.from_sonata import sonata2nwb
+        nwb_fpaths = {}
+        for size in SIZES:
+            data_dir = tempfile.mkdtemp(dir='.')
+            write_sonata(data_dir, *SIZES[size])
+            nwb_fpaths[size] = os.path.abspath('{}.nwb'.format(size))
+            sonata2nwb(data_dir, nwb_fpaths[size], buffer_gb=0.1)
+            shutil.rmtree(data_dir)
+        return nwb_fpaths
+
+    setup_cache.timeout = 1800
+
+    def setup(self, nwb_fpaths, size):
+        self.nwb_fpath = nwb_fpaths[size]
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def _save_dir(self):
+        # nwb2sonata creates the directory, so every run needs a new one
+        return os.path.join(tempfile.mkdtemp(dir=self.tmp_dir), 'exported')
+
+    def teardown(self, *args):
+        shutil.rmtree(self.tmp_dir)
+
+    def time_nwb2sonata(self, *args):
+        from ndx_simulation_output.io.to_sonata import nwb2sonata
+        nwb2sonata(self.nwb_fpath, self._save_dir())
+
+    def peakmem_nwb2sonata(self, *args):
+        from ndx_simulation_output.io.to_sonata import nwb2sonata
+        nwb2sonata(self.nwb_fpath, self._save_dir(), buffer_gb=0.1)
@@ -0,0 +1,13 @@
+"""Import times, measured in a fresh interpreter each time"""
+
+
+def timeraw_import_package():
+    return "import ndx_simulation_output"
+
+
+def timeraw_import_io():
+    return "import ndx_simulation_output.io"
+
+
+def timeraw_import_classes():
+    return "from ndx_simulation_output import CompartmentSeries"
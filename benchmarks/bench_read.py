@@ -0,0 +1,67 @@
+"""Queries and windowed reads of a CompartmentSeries in an NWB file. The NWB files of every size are converted once
+per run by setup_cache, the largest with about 1 GB of float32 data."""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from ndx_simulation_output.testing import write_report
+
+# n_cells, n_compartments (on average per cell)
+SIZES = {
+    '1000x10': (1000, 10),
+    '10000x10': (10000, 10),
+    '1000x100': (1000, 100),
+}
+
+
+class CompartmentSeriesRead:
+    params = list(SIZES)
+    param_names = ['size']
+    timeout = 600
+    n_times = 2500
+
+    def setup_cache(self):
+        from ndx_simulation_output.io.from_sonata import sonata2nwb
+        nwb_fpaths = {}
+        for size, (n_cells, n_compartments) in SIZES.items():
+            data_dir = tempfile.mkdtemp(dir='.')
+            write_report(os.path.join(data_dir, 'membrane_potential.h5'), n_cells, n_compartments, self.n_times,
+                         dtype='float32', offset=-65., vary_compartments=True, chunked=True, block_size=250)
+            nwb_fpaths[size] = os.path.abspath('{}.nwb'.format(size))
+            sonata2nwb(data_dir, nwb_fpaths[size], buffer_gb=0.1)
+            shutil.rmtree(data_dir)
+        return nwb_fpaths
+
+    setup_cache.timeout = 1800
+
+    def setup(self, nwb_fpaths, size):
+        from pynwb import NWBHDF5IO
+        n_cells = SIZES[size][0]
+        self.io = NWBHDF5IO(nwb_fpaths[size], 'r')
+        self.cs = self.io.read().acquisition['membrane_potential']
+        self.cs.find_compartments(0)  # build the in-memory lookup outside of the timed part
+        self.cells = np.random.default_rng(0).choice(n_cells, n_cells // 10, replace=False)
+
+    def teardown(self, *args):
+        self.io.close()
+
+    def time_find_compartments(self, *args):
+        for cell in self.cells[:100]:
+            self.cs.find_compartments(cell, compartment_numbers=0)
+
+    def time_find_compartments_batch(self, *args):
+        self.cs.find_compartments_batch(self.cells, compartment_numbers=0)
+
+    def time_get_data_window(self, *args):
+        self.cs.get_data(cells=self.cells, time_range=(.1, .2))
+
+    def time_get_data_all_cells_window(self, *args):
+        self.cs.get_data(time_range=(.1, .11))
+
+    def time_get_data_one_cell(self, *args):
+        self.cs.get_data(cells=self.cells[0])
+
+    def peakmem_get_data_window(self, *args):
+        self.cs.get_data(cells=self.cells, time_range=(.1, .2))
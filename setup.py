@@ -7,7 +7,7 @@ from shutil import copy2
 
 setup_args = {
     'name': 'ndx-simulation-output',
-    'version': '0.2.6',
+    'version': '0.3.0',
     'description': 'Holds structures for recording data from multiple compartments of multiple neurons in a single '
                    'TimeSeries',
     'author': 'Ben Dichter',
@@ -15,8 +15,11 @@ setup_args = {
     'url': '',
     'license': '',
     'install_requires': [
-        'pynwb>=1.1.2', 'tqdm'
+        'pynwb>=2.1', 'hdmf>=3.4'
     ],
+    'extras_require': {
+        'zarr': ['hdmf-zarr'],
+    },
     'packages': find_packages('src/pynwb'),
     'package_dir': {'': 'src/pynwb'},
     'package_data': {'ndx_simulation_output': [
@@ -27,6 +30,7 @@ setup_args = {
         "Intended Audience :: Developers",
         "Intended Audience :: Science/Research",
     ],
+    'python_requires': '>=3.7',
     'zip_safe': False
 }
 
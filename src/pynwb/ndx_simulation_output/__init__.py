@@ -1,5 +1,7 @@
 import os
-from pynwb import load_namespaces
+import sys
+from importlib import import_module
+from importlib.util import find_spec
 
 # Set path of the namespace.yaml file to the expected install location
 ndx_simulation_output_specpath = os.path.join(
@@ -17,7 +19,56 @@ if not os.path.exists(ndx_simulation_output_specpath):
         'ndx-simulation-output.namespace.yaml'
     ))
 
-# Load the namespace
-load_namespaces(ndx_simulation_output_specpath)
+# The namespace is loaded and the classes are generated by simulation_output, which is imported on first access of one
+# of its names (e.g. `from ndx_simulation_output import CompartmentSeries`), or as soon as pynwb is imported, so that
+# importing the package does not import pynwb, but files read with pynwb always get the classes of the extension.
+__all__ = ['namespace', 'create_ragged_array', 'Compartments', 'CompartmentSeries', 'DownsampledCompartmentSeries',
+           'SimulationMetaData', 'find_compartments', 'find_compartments_batch', 'get_data', 'get_downsampled',
+           'get_envelope', 'load_namespace']
 
-from .simulation_output import *
+
+def load_namespace():
+    """Load the ndx-simulation-output namespace and register its classes (with their methods) with pynwb"""
+    return import_module('.simulation_output', __name__)
+
+
+class _LoadWithPynwb(object):
+    """Finder on sys.meta_path that loads the namespace right after pynwb is imported. pynwb itself is found by the
+    finders that follow on sys.meta_path (e.g. those of editable installs), as if this one wasn't there."""
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname != 'pynwb':
+            return None
+        sys.meta_path.remove(self)
+        spec = find_spec(fullname)
+        if spec is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+        exec_module = spec.loader.exec_module
+
+        def exec_module_and_load_namespace(module):
+            exec_module(module)
+            load_namespace()
+
+        spec.loader.exec_module = exec_module_and_load_namespace
+        return spec
+
+
+if 'pynwb' in sys.modules:
+    load_namespace()
+else:
+    sys.meta_path.insert(0, _LoadWithPynwb())
+
+
+def __getattr__(name):
+    if name in __all__:
+        value = getattr(load_namespace(), name)
+    elif name == 'io':
+        value = import_module('.io', __name__)
+    else:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | {'io'})
@@ -1 +1,17 @@
-from .from_sonata import sonata2nwb
\ No newline at end of file
+from importlib import import_module
+
+# The converters import pandas, h5py and pynwb, so they are only imported on first use
+__all__ = ['sonata2nwb', 'nwb2sonata', 'add_downsampled']
+_submodules = {'sonata2nwb': '.from_sonata', 'nwb2sonata': '.to_sonata', 'add_downsampled': '.downsample'}
+
+
+def __getattr__(name):
+    if name not in _submodules:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    value = getattr(import_module(_submodules[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
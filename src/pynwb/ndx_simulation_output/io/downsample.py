@@ -0,0 +1,87 @@
+import numpy as np
+import h5py
+from ndx_simulation_output import DownsampledCompartmentSeries
+from pynwb import NWBHDF5IO, H5DataIO
+
+
+def add_downsampled(nwb_path, series_name='membrane_potential', factors=(10, 100, 1000), buffer_gb=1.0,
+                    module_name='downsampled'):
+    """Add min/max/mean envelopes of a CompartmentSeries at reduced rates to an NWB file, so that viewers can plot long
+    recordings from a coarse level (see CompartmentSeries.get_envelope). All levels are computed in a single streaming
+    pass over the full-rate data.
+
+    Parameters
+    ----------
+    nwb_path: str
+    series_name: str, optional
+        name of the CompartmentSeries in the acquisition of the file
+    factors: Iterable(int), optional
+        decimation of each level, e.g. (10, 100, 1000)
+    buffer_gb: float, optional
+        Maximum amount of full-rate data (in GB) read into memory at a time.
+    module_name: str, optional
+        Name of the processing module that holds the DownsampledCompartmentSeries, which are named
+        <series_name>_x<factor>.
+
+    """
+    factors = sorted(int(factor) for factor in factors)
+
+    with NWBHDF5IO(nwb_path, 'a') as io:
+        nwbfile = io.read()
+        series = nwbfile.acquisition[series_name]
+        if series.rate is None:
+            raise ValueError('{} has timestamps, only series with a rate can be downsampled'.format(series_name))
+        source_path = series.data.name
+        n_rows, n_cols = series.data.shape
+        dtype = np.result_type(series.data.dtype, np.float32)
+
+        if module_name in nwbfile.processing:
+            module = nwbfile.processing[module_name]
+        else:
+            module = nwbfile.create_processing_module(module_name, 'downsampled envelopes of continuous data')
+
+        level_paths = []
+        for factor in factors:
+            shape = (-(-n_rows // factor), n_cols)
+            level = DownsampledCompartmentSeries(
+                name='{}_x{}'.format(series_name, factor),
+                data=H5DataIO(shape=shape, dtype=dtype),
+                min=H5DataIO(shape=shape, dtype=dtype),
+                max=H5DataIO(shape=shape, dtype=dtype),
+                decimation=factor,
+                source=series,
+                unit=series.unit,
+                conversion=series.conversion,
+                offset=series.offset,
+                starting_time=series.starting_time,
+                rate=series.rate / factor)
+            module.add(level)
+            level_paths.append('/processing/{}/{}'.format(module_name, level.name))
+        io.write(nwbfile)
+
+    with h5py.File(nwb_path, 'a') as h5:
+        __fill_levels(h5[source_path], [h5[path] for path in level_paths], factors, buffer_gb)
+
+
+def __fill_levels(source, levels, factors, buffer_gb):
+    """Read source in blocks whose number of rows is a multiple of every factor, so that each window of each level lies
+    within a single block, and write the envelopes of every block to the levels. Empty levels are left as allocated."""
+    n_rows, n_cols = source.shape
+    if n_rows == 0 or n_cols == 0:
+        return
+    step = int(np.lcm.reduce(factors))
+    itemsize = np.dtype(levels[0]['data'].dtype).itemsize
+    block_rows = step * max(int(buffer_gb * 1e9 // (step * n_cols * itemsize)), 1)
+    block_cols = min(max(int(buffer_gb * 1e9 // (block_rows * itemsize)), 1), n_cols)
+
+    for col in range(0, n_cols, block_cols):
+        cols = slice(col, min(col + block_cols, n_cols))
+        for row in range(0, n_rows, block_rows):
+            block = np.asarray(source[row:row + block_rows, cols], dtype=levels[0]['data'].dtype)
+            for level, factor in zip(levels, factors):
+                starts = np.arange(0, len(block), factor)
+                counts = np.diff(np.r_[starts, len(block)])
+                rows = slice(row // factor, row // factor + len(starts))
+                level['data'][rows, cols] = np.add.reduceat(block, starts, axis=0) / counts[:, np.newaxis]
+                level['min'][rows, cols] = np.minimum.reduceat(block, starts, axis=0)
+                level['max'][rows, cols] = np.maximum.reduceat(block, starts, axis=0)
@@ -1,19 +1,122 @@
+import json
 import os
 import sys
+import warnings
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
+from functools import partial
 from glob import glob
 
 import numpy as np
 import pandas as pd
 import h5py
+from hdmf.common.table import DynamicTable, VectorData, VectorIndex
+from hdmf.data_utils import GenericDataChunkIterator, extend_data
 from ndx_simulation_output import (CompartmentSeries, Compartments,
                                    SimulationMetaData)
-from pynwb import NWBFile, NWBHDF5IO
+from ndx_simulation_output.io.downsample import add_downsampled
+from ndx_simulation_output.io.summary import SummaryStatistics, add_summary
+from ndx_simulation_output.simulation_output import _read_columns
+from pynwb import NWBFile, NWBHDF5IO, H5DataIO
 from pynwb.ecephys import ElectricalSeries
-from tqdm import tqdm
+from pynwb.misc import Units
 
 
-def add_continuous_compartments(nwbfile, data_fpath, name='membrane_potential', population=None, unit='mV', stub=False):
+class SonataDataChunkIterator(GenericDataChunkIterator):
+    """Iterates over a 2D SONATA data matrix (time x compartments or time x channels) in blocks of whole time steps,
+    or of whole chunks of columns if a band of chunks across all columns doesn't fit into the buffer, so that it can be
+    written to NWB without ever being loaded into memory at once."""
+
+    def __init__(self, dataset, buffer_gb=1.0, block_callback=None, transform=None, rows=None, columns=None, **kwargs):
+        """
+
+        Parameters
+        ----------
+        dataset: h5py.Dataset
+            The SONATA data, e.g. /report/<population>/data. The file must stay open until the data has been written.
+        buffer_gb: float, optional
+            Maximum amount of data (in GB) read into memory at a time. A buffer always holds at least one chunk.
+        block_callback: callable, optional
+            Called with every block that is read and the slice of its columns, e.g. SummaryStatistics.update. The
+            blocks of each column are passed in order of time.
+        transform: callable, optional
+            Applied to every block after it is read (and passed to block_callback), e.g. to change its dtype
+        rows: slice, optional
+            The time steps to iterate over. Defaults to all of them.
+        columns: numpy.ndarray, optional
+            Increasing indices of the columns to iterate over, e.g. the compartments of some cells. Defaults to all of
+            them. Only these columns are read from the SONATA file.
+        kwargs: fed into hdmf.data_utils.GenericDataChunkIterator (e.g. chunk_shape, chunk_mb, display_progress)
+
+        """
+        self.dataset = dataset
+        self.block_callback = block_callback
+        self.transform = transform
+        self.rows = slice(*(rows or slice(None)).indices(dataset.shape[0])[:2])
+        self.columns = np.asarray(columns) if columns is not None else None
+        super().__init__(buffer_gb=buffer_gb, **kwargs)
+
+    def _get_default_buffer_shape(self, buffer_gb):
+        """Buffer whole rows if a band of chunks across all columns fits, so every block is read from the SONATA file
+        with a single contiguous hyperslab. Otherwise, buffer one band of chunks split into as many whole chunks
+        along the columns as fit."""
+        n_rows, n_cols = self.maxshape
+        chunk_rows, chunk_cols = self.chunk_shape
+        itemsize = self.dtype.itemsize
+        n_blocks = int(buffer_gb * 1e9 // (chunk_rows * n_cols * itemsize))
+        if n_blocks:
+            return min(n_blocks * chunk_rows, n_rows), n_cols
+        n_chunks = max(int(buffer_gb * 1e9 // (chunk_rows * chunk_cols * itemsize)), 1)
+        return chunk_rows, min(n_chunks * chunk_cols, n_cols)
+
+    def _get_data(self, selection):
+        row_selection, column_selection = selection
+        rows = slice(self.rows.start + row_selection.start, self.rows.start + row_selection.stop)
+        columns = self.columns[column_selection] if self.columns is not None else column_selection
+        block = _read_selection(self.dataset, rows, columns)
+        if self.block_callback is not None:
+            self.block_callback(block, column_selection)
+        return self.transform(block) if self.transform is not None else block
+
+    def _get_maxshape(self):
+        n_columns = len(self.columns) if self.columns is not None else self.dataset.shape[1]
+        return self.rows.stop - self.rows.start, n_columns
+
+    def _get_dtype(self):
+        if self.transform is not None:
+            return self.transform(self.dataset[:0]).dtype
+        return self.dataset.dtype
+
+    def _to_dict(self):
+        """Everything needed to rebuild the iterator in another process, which opens the SONATA file again. Blocks read
+        in other processes are not passed to block_callback."""
+        return dict(file_name=self.dataset.file.filename, data_path=self.dataset.name, buffer_shape=self.buffer_shape,
+                    chunk_shape=self.chunk_shape, transform=self.transform, rows=self.rows, columns=self.columns,
+                    display_progress=False)
+
+    @staticmethod
+    def _from_dict(dictionary):
+        dictionary = dict(dictionary)
+        dataset = h5py.File(dictionary.pop('file_name'), 'r')[dictionary.pop('data_path')]
+        return SonataDataChunkIterator(dataset, buffer_gb=None, **dictionary)
+
+    def __reduce__(self):
+        # h5py datasets can't be pickled, e.g. to write blocks in parallel with hdmf_zarr
+        return SonataDataChunkIterator._from_dict, (self._to_dict(),)
+
+
+def _read_selection(dataset, rows, columns=None):
+    """Reads the rows (slice with start and stop) and columns (sorted, unique indices, or a slice) of a 2D
+    h5py.Dataset. Selected columns are read as the union of one hyperslab per run of adjacent columns."""
+    if columns is None or isinstance(columns, slice):
+        return dataset[rows, columns if columns is not None else slice(None)]
+    return _read_columns(dataset, rows, columns)
+
+
+def add_continuous_compartments(nwbfile, data_fpath, name='membrane_potential', population=None, unit='mV', stub=False,
+                                buffer_gb=None, data_io_kwargs=None):
     """
 
     Parameters
@@ -28,14 +131,29 @@ def add_continuous_compartments(nwbfile, data_fpath, name='membrane_potential',
     population: str
         Name of the sonata node-population to convert. If not specified or set to None will try to guess the correct
         population to convert.
+    buffer_gb: float, optional
+        If specified, the data is not loaded into memory but streamed from data_fpath in blocks of at most buffer_gb
+        gigabytes when the NWBFile is written. The caller must then write nwbfile before data_fpath is modified or
+        deleted.
+    data_io_kwargs: dict, optional
+        Options for writing the data, fed into pynwb.H5DataIO (e.g. chunks, compression, compression_opts, shuffle).
+        If chunks is not specified, a chunk shape suited to reading the compartments of a few cells is used.
 
     Returns
     -------
     pynwb.NWBFile
     """
+    if buffer_gb is not None and not stub:
+        # keep the file open, it is closed once the data iterator is garbage collected
+        h5 = h5py.File(data_fpath, 'r')
+        pop, report_grp, _, _ = __parse_h5_tree(h5, data_fpath, population)
+        return __add_continuous_compartments_helper(nwbfile, report_grp, population_name=pop, name=name, unit=unit,
+                                                    buffer_gb=buffer_gb, data_io_kwargs=data_io_kwargs)
+
     with h5py.File(data_fpath, 'r') as h5:
         pop, report_grp, _, _ = __parse_h5_tree(h5, data_fpath, population)
-        nwbfile = __add_spikes_helper(nwbfile, report_grp, population=pop, name=name, unit=unit, stub=stub)
+        nwbfile = __add_continuous_compartments_helper(nwbfile, report_grp, population_name=pop, name=name, unit=unit,
+                                                       stub=stub, data_io_kwargs=data_io_kwargs)
     return nwbfile
 
 
@@ -62,7 +180,7 @@ def add_spikes(nwbfile, spikes_fpath, population=None):
     return nwbfile
 
 
-def add_electrodes(nwbfile, electrode_positions_file, electrodes_data_file):
+def add_electrodes(nwbfile, electrode_positions_file, electrodes_data_file, data_io_kwargs=None, buffer_gb=None):
     """
 
     Parameters
@@ -70,21 +188,38 @@ def add_electrodes(nwbfile, electrode_positions_file, electrodes_data_file):
     nwbfile: pynwb.NWBFile
     electrode_positions_file: str
     electrodes_data_file: str
+    data_io_kwargs: dict, optional
+        Options for writing the ElectricalSeries data, fed into pynwb.H5DataIO. If chunks is a shape, e.g. (10000, 64),
+        streamed data is also read in blocks of whole chunks.
+    buffer_gb: float, optional
+        If specified, the data is not loaded into memory but streamed from electrodes_data_file in blocks of at most
+        buffer_gb gigabytes when the NWBFile is written. The caller must then write nwbfile before electrodes_data_file
+        is modified or deleted.
 
     Returns
     -------
     pnwb.NWBFile
 
     """
+    if buffer_gb is not None:
+        # keep the file open, it is closed once the data iterator is garbage collected
+        h5 = h5py.File(electrodes_data_file, 'r')
+        _, _, _, ecp_grp = __parse_h5_tree(h5, electrodes_data_file)
+        return __add_electrodes_helper(nwbfile, ecp_grp, electrode_positions_file, data_io_kwargs=data_io_kwargs,
+                                       buffer_gb=buffer_gb)
+
     with h5py.File(electrodes_data_file, 'r') as h5:
         _, _, _, ecp_grp = __parse_h5_tree(h5, electrodes_data_file)
-        nwbfile = __add_electrodes_helper(nwbfile, electrodes_data_file, electrode_positions_file)
+        nwbfile = __add_electrodes_helper(nwbfile, ecp_grp, electrode_positions_file, data_io_kwargs=data_io_kwargs)
 
     return nwbfile
 
 
 def sonata2nwb(data_path, save_path=None, electrodes_file=None, stub=False, description='description',
-               identifier='id', population=None, compartment_report_name=None, **kwargs):
+               identifier='id', population=None, compartment_report_name=None, buffer_gb=None, data_io_kwargs=None,
+               n_jobs=1, downsample=None, summary=False, summary_threshold=None, append=False, until=None,
+               link_mode=None, report_dtype=None, report_resolution=None, report_offset=0., backend='hdf5',
+               rank_reports=None, node_ids=None, compartments=None, time_range=None, **kwargs):
     """Example of a conversion from sonata to NWB
 
     Parameters
@@ -97,11 +232,83 @@ def sonata2nwb(data_path, save_path=None, electrodes_file=None, stub=False, desc
         NWBFile.description
     identifier: str, optional
         NWBFile.id
-    population: str
-        Name of the sonata node-population to convert. If not specified or set to None will try to guess the correct
-        population to convert.
+    population: str or list of str, optional
+        Name(s) of the sonata node-population(s) to convert. If not specified or set to None, all populations are
+        converted in one pass over each file. The reports of files with several populations are converted to one
+        CompartmentSeries per population, named <report name>_<population>. When several populations are converted
+        (from one file or from separate files), each population's report gets its Compartments table
+        compartments_<population> in SimulationMetaData, and the units get a population column. append and
+        rank_reports need a single population in each file.
     compartment_report_name: str
         Name of Compartments table. If not specified will try to guess from file-name.
+    buffer_gb: float, optional
+        If specified, compartment reports and the ECP are streamed into the NWB file in blocks of at most buffer_gb
+        gigabytes instead of being loaded into memory, so that peak memory does not depend on the size of the reports.
+    data_io_kwargs: dict, optional
+        Options for writing each dataset, keyed by the name of the series (e.g. 'membrane_potential',
+        'ElectricalSeries'). The values are dicts fed into pynwb.H5DataIO, e.g.
+        {'membrane_potential': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}}. Plugin filters such as
+        blosc can be used with e.g. dict(**hdf5plugin.Blosc(), allow_plugin_filters=True). Compartment reports get a
+        default chunk shape suited to reading the compartments of a few cells over a window of time. With the zarr
+        backend, they are fed into hdmf_zarr.ZarrDataIO instead, e.g. {'compressor': numcodecs.Blosc(cname='zstd')}.
+    n_jobs: int, optional
+        Number of worker processes that read and preprocess the sonata files in parallel (e.g. the membrane, calcium,
+        spikes and ECP files of a run), while this process assembles and writes the NWBFile. With the zarr backend, the
+        same number of processes then compress and write the chunks of streamed reports in parallel. If None, one
+        process per cpu is used.
+    downsample: Iterable(int), optional
+        If specified, min/max/mean envelopes of each compartment report are added at these decimations, e.g.
+        (10, 100, 1000). See add_downsampled.
+    summary: bool, optional
+        If True, the mean, std, min and max of every compartment are accumulated while the reports are converted and
+        stored in processing/summary/<report name>_summary, so that QC does not need another pass over the data.
+    summary_threshold: float, optional
+        If specified with summary, the number of upward crossings of this threshold (in the unit of the report) is also
+        counted for every compartment.
+    append: bool, optional
+        Convert the output of a simulation that is still running. The series are created extendable and the time steps
+        and spikes written to the sonata files since the previous call are appended to save_path. The number of time
+        steps and spikes converted from each file is recorded in <save_path>.progress.json. Spikes are taken in the
+        order they were written. Long conversions are resumable in this mode: the data are copied in segments of
+        buffer_gb that are recorded with their checksums as soon as they are written, and running the same call again
+        after an interruption verifies the last segment and continues from there.
+    until: float, optional
+        With append, the time (in the time units of the sonata files, usually ms) up to which the simulation has written
+        its output. Defaults to everything in the files, which suits files that grow as the simulation advances.
+    link_mode: str, optional
+        If 'virtual', the data of the compartment reports and the ECP are not copied, but stored as HDF5 virtual
+        datasets that map the data in the sonata files, so that the conversion takes seconds and no extra storage. The
+        sonata files are referred to by their path relative to save_path and have to stay there. Defaults to copying.
+    report_dtype: str or numpy.dtype, optional
+        dtype the data of the compartment reports are stored with, e.g. 'float32' or 'float16'. Defaults to the dtype
+        of the sonata files.
+    report_resolution: float, optional
+        If specified, the data of the compartment reports are quantized to int16 steps of report_resolution (in the unit
+        of the report) above report_offset, which are stored as the conversion and offset of the CompartmentSeries, so
+        that pynwb users still get values in the unit of the report. Values outside of the 65536 steps are clipped.
+    report_offset: float, optional
+        Value of the int16 zero with report_resolution, e.g. the resting potential.
+    backend: str, optional
+        'hdf5' (default) or 'zarr', which writes save_path as a Zarr directory store with hdmf_zarr (which has to be
+        installed), so that many processes can read it at the same time. append, link_mode, downsample and summary
+        need the hdf5 backend.
+    rank_reports: dict, optional
+        Compartment reports written in pieces by the ranks of a parallel simulation, as {report name: [file of each
+        rank]}, converted in addition to data_path. The pieces (each with the compartments of some of the cells, and
+        all time steps) are merged into one CompartmentSeries and one Compartments table, and n_jobs processes write
+        the columns of the pieces into the data at the same time. For this, the data is stored contiguous, without
+        chunks or compression, so data_io_kwargs can't be given for their names.
+    node_ids: Iterable(int) or dict, optional
+        Only convert the compartments and spikes of these nodes (cells), e.g. range(1000, 2000). The node ids are
+        selected in every population, unless given by population, e.g. {'v1': range(100), 'lgn': [0, 1]}, in which
+        case the populations that are left out are converted without nodes.
+    compartments: Iterable(int), optional
+        Only convert the compartments with these numbers (element ids), e.g. [0] for the somas.
+    time_range: (float, float), optional
+        Only convert the time steps, ECP and spikes in [start, stop), in the time units of the sonata files (usually
+        ms). These filters are pushed down into the reads of the sonata files: only the selected hyperslabs of the data
+        are read, and time windows of spikes sorted by time are found by bisection. They can't be combined with
+        append, link_mode and rank_reports.
     kwargs: fed into NWBFile
 
     """
@@ -110,9 +317,148 @@ def sonata2nwb(data_path, save_path=None, electrodes_file=None, stub=False, desc
         # TODO: Make this more robust
         save_path = data_path + '.nwb'
 
-    # Create a list of the sonata file(s) passed in by the user, based of if data_path parameter is a single file, list
-    # of files, or a directory containing multiple files.
     nwbfile = NWBFile(description, identifier, datetime.now().astimezone(), **kwargs)
+    sonata_files = __list_sonata_files(data_path)
+
+    data_io_kwargs = data_io_kwargs or dict()
+
+    if electrodes_file is None:
+        electrodes_file = __find_electrodes_file(data_path)
+
+    encoding = dict(dtype=report_dtype, resolution=report_resolution, offset=report_offset)
+    __check_options(backend, link_mode, append, downsample, summary, encoding, rank_reports, data_io_kwargs,
+                    filtered=node_ids is not None or compartments is not None or time_range is not None)
+    virtual = link_mode == 'virtual'
+    data_io = __get_data_io_class(backend)
+    read_file = partial(__read_sonata_file, population=population, stub=stub,
+                        load_data=buffer_gb is None and not virtual, read_ecp=electrodes_file is not None,
+                        load_ecp=buffer_gb is None and not virtual, node_ids=node_ids, compartments=compartments,
+                        time_range=time_range)
+    n_jobs = n_jobs or os.cpu_count()
+    n_read_jobs = min(n_jobs, len(sonata_files))
+
+    if append:
+        return __append_sonata_files(sonata_files, save_path, nwbfile, population=population,
+                                     compartment_report_name=compartment_report_name, electrodes_file=electrodes_file,
+                                     buffer_gb=buffer_gb, data_io_kwargs=data_io_kwargs, until=until,
+                                     encoding=encoding)
+
+    report_names = []
+    report_statistics = []
+    virtual_datasets = []
+    spikes = []
+    # When streaming, the sonata files must stay open until the nwb file has been written.
+    with ExitStack() as open_files:
+        if n_read_jobs > 1:
+            pool = open_files.enter_context(ProcessPoolExecutor(n_read_jobs))
+            contents = list(pool.map(read_file, sonata_files))
+        else:
+            contents = [read_file(file_name) for file_name in sonata_files]
+        # reports of several populations (of one file or of separate files) get a Compartments table each
+        several_populations = len({report['population'] for content in contents for report in content['reports']}) > 1
+
+        # Parse each sonata file checking to see what type or report(s) are contained within each.
+        for file_name, content in zip(sonata_files, contents):
+            h5 = None
+            for report in content['reports']:
+                name = __get_report_name(file_name, compartment_report_name,
+                                         report['population'] if len(content['reports']) > 1 else None)
+                report = dict(report, population=report['population'] if several_populations else None)
+                dataset = None
+                if report['data'] is None:
+                    # one handle for the reports of all populations in the file
+                    h5 = h5 or open_files.enter_context(h5py.File(file_name, 'r'))
+                    dataset = h5[report['data_path']]
+                # convert the sonata /report/<population> group and insert into nwbfile
+                statistics = SummaryStatistics(summary_threshold) if summary else None
+                nwbfile = __add_report(nwbfile, report, dataset=dataset, name=name, buffer_gb=buffer_gb,
+                                       data_io_kwargs=data_io_kwargs.get(name), statistics=statistics,
+                                       extendable=virtual, encoding=encoding, data_io=data_io)
+                report_names.append(name)
+                report_statistics.append(statistics)
+                virtual_datasets.append(('acquisition/{}/data'.format(name), file_name, report['data_path']))
+
+            if content['spikes'] is not None:
+                spikes += list(content['spikes'].items())
+
+            if content['ecp'] is not None:
+                # convert the /ecp report to nwb, but only if there exists a
+                dataset = None
+                if content['ecp']['data'] is None and not virtual:
+                    h5 = h5 or open_files.enter_context(h5py.File(file_name, 'r'))
+                    dataset = h5['/ecp/data']
+                nwbfile = __add_ecp(nwbfile, content['ecp'], electrodes_file,
+                                    data_io_kwargs=data_io_kwargs.get('ElectricalSeries'), extendable=virtual,
+                                    data_io=data_io, dataset=dataset, buffer_gb=buffer_gb)
+                virtual_datasets.append(('acquisition/ElectricalSeries/data', file_name, '/ecp/data'))
+
+        if spikes:
+            # the units of all files and populations are built at once, with a population column for several
+            nwbfile = __add_units(nwbfile, __merge_spikes(spikes))
+
+        rank_pieces = {name: __add_rank_report(nwbfile, name, file_names, population=population, encoding=encoding)
+                       for name, file_names in (rank_reports or dict()).items()}
+        report_names += list(rank_pieces)
+        report_statistics += [None] * len(rank_pieces)
+
+        __write_nwbfile(nwbfile, save_path, backend, n_jobs)
+
+    if virtual:
+        __add_virtual_datasets(save_path, virtual_datasets)
+    __fill_rank_reports(save_path, rank_pieces, n_jobs=n_jobs, buffer_gb=buffer_gb or 1.0, encoding=encoding)
+
+    for name, statistics in zip(report_names, report_statistics):
+        if statistics is not None:
+            add_summary(save_path, name, statistics)
+        if downsample:
+            add_downsampled(save_path, name, factors=downsample, buffer_gb=buffer_gb or 1.0)
+
+
+def __check_options(backend, link_mode, append, downsample, summary, encoding, rank_reports=None,
+                    data_io_kwargs=None, filtered=False):
+    """Raises a ValueError for options of sonata2nwb that can't be combined"""
+    if backend not in ('hdf5', 'zarr'):
+        raise ValueError("backend must be 'hdf5' or 'zarr', not {}".format(backend))
+    if link_mode not in (None, 'virtual'):
+        raise ValueError("link_mode must be None or 'virtual', not {}".format(link_mode))
+    if link_mode and (summary or encoding['dtype'] is not None or encoding['resolution'] is not None):
+        raise ValueError('link_mode does not support summary, report_dtype and report_resolution')
+    if append and (downsample or link_mode or summary):
+        raise ValueError('downsample, summary and link_mode are not supported in append mode')
+    if backend == 'zarr' and (append or link_mode or downsample or summary):
+        raise ValueError('append, link_mode, downsample and summary are not supported by the zarr backend')
+    if rank_reports and (append or summary or backend != 'hdf5'):
+        raise ValueError('rank_reports are not supported with append, summary and the zarr backend')
+    if set(rank_reports or ()) & set(data_io_kwargs or ()):
+        raise ValueError('data_io_kwargs are not supported for rank_reports, whose data is contiguous: {}'.format(
+            sorted(set(rank_reports) & set(data_io_kwargs))))
+    if filtered and (append or link_mode or rank_reports):
+        raise ValueError('node_ids, compartments and time_range are not supported with append, link_mode and '
+                         'rank_reports')
+
+
+def __get_data_io_class(backend):
+    if backend == 'zarr':
+        from hdmf_zarr import ZarrDataIO
+        return ZarrDataIO
+    return H5DataIO
+
+
+def __write_nwbfile(nwbfile, save_path, backend='hdf5', n_jobs=1):
+    """Writes the nwbfile to an HDF5 file, or to a Zarr directory store with streamed data written by n_jobs
+    processes"""
+    if backend == 'zarr':
+        from hdmf_zarr.nwb import NWBZarrIO
+        with NWBZarrIO(save_path, 'w') as io:
+            io.write(nwbfile, cache_spec=True, number_of_jobs=n_jobs)
+    else:
+        with NWBHDF5IO(save_path, 'w') as io:
+            io.write(nwbfile, cache_spec=True)
+
+
+def __list_sonata_files(data_path):
+    """Create a list of the sonata file(s) passed in by the user, based of if data_path parameter is a single file, list
+    of files, or a directory containing multiple files."""
     if isinstance(data_path, (list, tuple)):
         sonata_files = data_path
 
@@ -127,34 +473,378 @@ def sonata2nwb(data_path, save_path=None, electrodes_file=None, stub=False, desc
     else:
         raise TypeError('Unable to read data_path {}. Please specify a directory '.format(data_path))
 
-    if electrodes_file is None:
-        # See if there exists an electrodes.csv file containg channel positions
-        # TODO: parse the csv file to make sure it's actually an appropiately formatted electrodes file
-        csv_files = [fn for fn in glob('{}/*'.format(data_path)) if os.path.isfile(fn) and fn.endswith('.csv')]
-        if csv_files:
-            electrodes_file = csv_files[0]
+    return sonata_files
 
-    for file_name in sonata_files:
-        # Parse each sonata file checking to see what type or report(s) are contained within each.
-        with h5py.File(file_name, 'r') as h5:
-            pop, report_grp, spikes_grp, ecp_grp = __parse_h5_tree(h5, file_name, population)
-            if report_grp:
-                # If the compartment report name is not specified by the user, get it from the file name
-                name = compartment_report_name or os.path.splitext(os.path.basename(file_name))[0]  # /path/to/membrane.h5 --> membrane
-                # convert the sonata /report/<population> group and insert into nwbfile
-                nwbfile = __add_continuous_compartments_helper(nwbfile, report_grp, pop, name=name, stub=stub)
 
-            if spikes_grp:
-                # convert sonata spikes and insert into nwbfile
-                nwbfile = __add_spikes_helper(nwbfile, spikes_grp, pop)
+def __find_electrodes_file(data_path):
+    """See if there exists an electrodes.csv file containg channel positions"""
+    # TODO: parse the csv file to make sure it's actually an appropiately formatted electrodes file
+    csv_files = [fn for fn in glob('{}/*'.format(data_path)) if os.path.isfile(fn) and fn.endswith('.csv')]
+    return csv_files[0] if csv_files else None
 
-            if ecp_grp and electrodes_file:
-                # convert the /ecp report to nwb, but only if there exists a
-                nwbfile = __add_electrodes_helper(nwbfile, ecp_grp, electrodes_file)
 
-    with NWBHDF5IO(save_path, 'w') as io:
+def __get_report_name(file_name, compartment_report_name=None, population=None):
+    # If the compartment report name is not specified by the user, get it from the file name
+    name = compartment_report_name or os.path.splitext(os.path.basename(file_name))[0]  # /path/to/membrane.h5 --> membrane
+    # reports of files with several populations are told apart by their population, e.g. membrane_v1 and membrane_lgn
+    return '{}_{}'.format(name, population) if population is not None else name
+
+
+def __append_sonata_files(sonata_files, save_path, nwbfile, population=None, compartment_report_name=None,
+                          electrodes_file=None, buffer_gb=None, data_io_kwargs=None, until=None, encoding=None):
+    """Appends what was written to the sonata files since the last call to save_path. Series that are not in save_path
+    yet (all of them, if it doesn't exist) are first added empty and extendable, then the new time steps and spikes
+    are copied with h5py, in segments that are recorded with their checksums in <save_path>.progress.json as soon as
+    they are written, so that an interrupted conversion resumes from its last intact segment. The data of the reports
+    are stored with encoding (see __get_encoder)."""
+    data_io_kwargs = data_io_kwargs or dict()
+    encoding = encoding or dict()
+    progress_path = save_path + '.progress.json'
+    exists = os.path.exists(save_path)
+    progress = __load_progress(progress_path) if exists else {'files': dict(), 'segments': dict()}
+
+    with NWBHDF5IO(save_path, 'a' if exists else 'w') as io:
+        if exists:
+            nwbfile = io.read()
+        for file_name in sonata_files:
+            with h5py.File(file_name, 'r') as h5:
+                pop, report_grp, spikes_grp, ecp_grp = __parse_h5_tree(h5, file_name, population)
+                name = __get_report_name(file_name, compartment_report_name)
+                if report_grp is not None and name not in nwbfile.acquisition:
+                    __add_report(nwbfile, __read_report(report_grp, load_data=False), dataset=report_grp['data'],
+                                 name=name, data_io_kwargs=data_io_kwargs.get(name), extendable=True,
+                                 encoding=encoding)
+                if spikes_grp is not None and nwbfile.units is None:
+                    no_spikes = {'unit_ids': np.zeros(0, dtype=int), 'timestamps': np.zeros(0),
+                                 'stops': np.zeros(0, dtype=int)}
+                    __add_units(nwbfile, no_spikes, extendable=True)
+                if ecp_grp is not None and electrodes_file and 'ElectricalSeries' not in nwbfile.acquisition:
+                    __add_ecp(nwbfile, __read_ecp(ecp_grp, load_data=False), electrodes_file,
+                              data_io_kwargs=data_io_kwargs.get('ElectricalSeries'), extendable=True)
         io.write(nwbfile, cache_spec=True)
 
+    buffer_gb = buffer_gb or 1.0
+    spikes = []
+    with h5py.File(save_path, 'a') as nwb_h5:
+        for file_name in sonata_files:
+            key = os.path.abspath(file_name)
+            file_progress = progress['files'].setdefault(key, dict())
+            file_segments = progress['segments'].setdefault(key, dict())
+            with h5py.File(file_name, 'r') as h5:
+                pop, report_grp, spikes_grp, ecp_grp = __parse_h5_tree(h5, file_name, population)
+                series = []
+                if report_grp is not None:
+                    target = nwb_h5['acquisition'][__get_report_name(file_name, compartment_report_name)]['data']
+                    series.append(('report', target, report_grp['data'], report_grp['mapping/time'],
+                                   __get_encoder(**encoding)[0]))
+                if ecp_grp is not None and electrodes_file:
+                    series.append(('ecp', nwb_h5['acquisition/ElectricalSeries/data'], ecp_grp['data'],
+                                   ecp_grp['time'], None))
+                for series_key, target, source, time, transform in series:
+                    segments = file_segments.setdefault(series_key, [])
+                    done = __verify_segments(target, source, segments, file_progress.get(series_key, 0), transform)
+                    checkpoint = partial(__checkpoint, nwb_h5, progress_path, progress, file_progress, segments,
+                                         series_key)
+                    file_progress[series_key] = __extend_series(target, source, time, done, until, buffer_gb,
+                                                                checkpoint, transform)
+                if spikes_grp is not None:
+                    n_spikes, node_ids, timestamps = __read_new_spikes(spikes_grp, file_progress.get('spikes', 0),
+                                                                       until)
+                    spikes.append((key, n_spikes, node_ids, timestamps))
+
+        if spikes:
+            __update_units(nwb_h5['units'], progress, np.concatenate([x[2] for x in spikes]),
+                           np.concatenate([x[3] for x in spikes]), population=population)
+            for key, n_spikes, _, _ in spikes:
+                progress['files'][key]['spikes'] = n_spikes
+        nwb_h5.flush()
+        __save_progress(progress_path, progress)
+
+
+def __add_rank_report(nwbfile, name, file_names, population=None, encoding=None):
+    """Adds the pieces of a compartment report written by the ranks of a simulation (each with the compartments of
+    some of the cells) as one CompartmentSeries, with the compartments of all cells. The data is allocated contiguous
+    and empty, to be filled by __fill_rank_reports once the nwbfile is written.
+
+    :return: list of (file name, data path, first column in the CompartmentSeries) of each piece
+    """
+    reports, shapes, dtypes = [], [], []
+    for file_name in file_names:
+        with h5py.File(file_name, 'r') as h5:
+            _, report_grp, _, _ = __parse_h5_tree(h5, file_name, population)
+            reports.append(__read_report(report_grp, load_data=False))
+            shapes.append(report_grp['data'].shape)
+            dtypes.append(report_grp['data'].dtype)
+    if len({shape[0] for shape in shapes}) > 1 or len({(report['rate'], report['starting_time'])
+                                                       for report in reports}) > 1:
+        raise ValueError('The pieces of {} have different time steps'.format(name))
+
+    # concatenate the mappings of the pieces, with the columns of each piece after those of the previous ones
+    first_columns = np.cumsum([0] + [shape[1] for shape in shapes])
+    index_pointer = np.concatenate([report['index_pointer'][:-1] + first_column
+                                    for report, first_column in zip(reports, first_columns)] +
+                                   [reports[-1]['index_pointer'][-1:] + first_columns[-2]])
+    report = dict(reports[0], file_name=', '.join(file_names), index_pointer=index_pointer,
+                  **{key: np.concatenate([report[key] for report in reports])
+                     for key in ('element_ids', 'element_pos', 'node_ids')})
+
+    encode, encoding_kwargs = __get_encoder(**(encoding or dict()))
+    dtype = np.result_type(*dtypes)
+    if encode is not None:
+        dtype = encode(np.zeros(0, dtype=dtype)).dtype
+    cs = CompartmentSeries(name, H5DataIO(shape=(shapes[0][0], first_columns[-1]), dtype=dtype),
+                           compartments=__get_compartments(nwbfile, report),
+                           unit=report['unit'], rate=report['rate'], starting_time=report['starting_time'],
+                           **encoding_kwargs)
+    nwbfile.add_acquisition(cs)
+
+    return [(report['file_name'], report['data_path'], first_column)
+            for report, first_column in zip(reports, first_columns)]
+
+
+def __fill_rank_reports(save_path, rank_pieces, n_jobs=1, buffer_gb=1.0, encoding=None):
+    """Writes the pieces of the rank reports added by __add_rank_report into their columns of the contiguous data in
+    save_path, with n_jobs processes that write straight into the file at the offset of the data"""
+    if not rank_pieces:
+        return
+
+    jobs = []
+    with h5py.File(save_path, 'a') as h5:
+        for name, pieces in rank_pieces.items():
+            dset = h5['acquisition'][name]['data']
+            dset[-1:, -1:] = dset.fillvalue  # allocates the contiguous data, so that it has an offset in the file
+            target = dict(offset=dset.id.get_offset(), shape=dset.shape, dtype=dset.dtype)
+            jobs += [dict(target, file_name=file_name, data_path=data_path, first_column=first_column)
+                     for file_name, data_path, first_column in pieces]
+
+    write_piece = partial(__write_rank_piece, save_path, buffer_gb=buffer_gb, transform=__get_encoder(
+        **(encoding or dict()))[0])
+    if n_jobs > 1:
+        with ProcessPoolExecutor(min(n_jobs, len(jobs))) as pool:
+            list(pool.map(write_piece, jobs))
+    else:
+        list(map(write_piece, jobs))
+
+
+def __write_rank_piece(save_path, job, buffer_gb=1.0, transform=None):
+    """Copies the data of one piece of a rank report into its columns of the contiguous data in save_path, in blocks of
+    at most buffer_gb"""
+    target = np.memmap(save_path, dtype=job['dtype'], mode='r+', offset=job['offset'], shape=job['shape'])
+    with h5py.File(job['file_name'], 'r') as h5:
+        source = h5[job['data_path']]
+        n_rows, n_cols = source.shape
+        columns = slice(job['first_column'], job['first_column'] + n_cols)
+        block_rows = max(int(buffer_gb * 1e9 // (source.dtype.itemsize * max(n_cols, 1))), 1)
+        for start in range(0, n_rows, block_rows):
+            block = source[start:start + block_rows]
+            target[start:start + len(block), columns] = transform(block) if transform is not None else block
+    target.flush()
+
+
+def __add_virtual_datasets(save_path, virtual_datasets):
+    """Replaces the (empty) datasets written for the data of each series by virtual datasets mapping the data of the
+    sonata files. The attributes of the datasets (unit, conversion etc.) are kept.
+
+    :param virtual_datasets: list of (path of the dataset in save_path, sonata file name, path of the data in the file)
+    """
+    save_dir = os.path.dirname(os.path.abspath(save_path))
+    with h5py.File(save_path, 'a') as nwb_h5:
+        for path, file_name, data_path in virtual_datasets:
+            with h5py.File(file_name, 'r') as h5:
+                shape, dtype = h5[data_path].shape, h5[data_path].dtype
+            layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+            # a relative path is looked up next to save_path, so the files can be moved together
+            layout[...] = h5py.VirtualSource(os.path.relpath(os.path.abspath(file_name), save_dir), data_path,
+                                             shape=shape)
+            attrs = dict(nwb_h5[path].attrs)
+            del nwb_h5[path]
+            dset = nwb_h5.create_virtual_dataset(path, layout)
+            for key, value in attrs.items():
+                dset.attrs[key] = value
+
+
+def __extend_series(target, source, time, done, until=None, buffer_gb=1.0, checkpoint=None, transform=None):
+    """Copies the time steps of source (time x columns) after the first done up to until (or the end of source) to
+    target, in segments of at most buffer_gb, and returns the number of time steps converted. checkpoint is called with
+    the start, stop and checksum of every segment once it is copied. transform is applied to every segment."""
+    n_rows = source.shape[0]
+    if until is not None:
+        start, stop, step = time[:]
+        n_rows = min(n_rows, max(int(np.ceil((until - start) / step)), 0))
+    if n_rows <= done:
+        return done
+
+    target.resize(n_rows, axis=0)
+    block_rows = max(int(buffer_gb * 1e9 // (source.dtype.itemsize * max(source.shape[1], 1))), 1)
+    for block_start in range(done, n_rows, block_rows):
+        block_stop = min(block_start + block_rows, n_rows)
+        block = source[block_start:block_stop]
+        if transform is not None:
+            block = transform(block)
+        target[block_start:block_stop] = block
+        if checkpoint is not None:
+            checkpoint(block_start, block_stop, __checksum(block))
+    return n_rows
+
+
+def __checkpoint(nwb_h5, progress_path, progress, file_progress, segments, series_key, start, stop, checksum):
+    """Records a copied segment of a series once it is flushed to the nwb file"""
+    nwb_h5.flush()
+    segments.append([int(start), int(stop), checksum])
+    file_progress[series_key] = int(stop)
+    __save_progress(progress_path, progress)
+
+
+def __verify_segments(target, source, segments, done, transform=None):
+    """Checks the last recorded segment of a series against its checksum, in the nwb file and in the sonata file
+    (after transform), and returns the number of time steps that were converted intact. Segments that don't match in
+    the nwb file (e.g. because the conversion was killed while writing them) are dropped, so that they are converted
+    again."""
+    if not segments:
+        return min(done, target.shape[0])
+    while segments:
+        start, stop, checksum = segments[-1]
+        if stop <= target.shape[0] and __checksum(target[start:stop]) == checksum:
+            block = source[start:stop]
+            if __checksum(transform(block) if transform is not None else block) != checksum:
+                raise ValueError('{} has changed since it was converted. Convert it to a new file.'.format(
+                    source.file.filename))
+            return stop
+        segments.pop()
+    return 0
+
+
+def __checksum(block):
+    return zlib.crc32(np.ascontiguousarray(block).view(np.uint8))
+
+
+def __read_new_spikes(spikes_grp, done, until=None):
+    """Reads the spikes of a /spikes/<population> group after the first done (and before until). Returns the number of
+    spikes converted with them and their node_ids and timestamps."""
+    node_ids = spikes_grp['node_ids'][done:]
+    timestamps = spikes_grp['timestamps'][done:]
+    if until is not None:
+        # spikes are written in time order, so everything from the first new spike at or after until is incomplete
+        later = timestamps >= until
+        n_new = np.argmax(later) if later.any() else len(later)
+        node_ids, timestamps = node_ids[:n_new], timestamps[:n_new]
+    return done + len(node_ids), node_ids, timestamps
+
+
+def __update_units(units_grp, progress, node_ids, timestamps, population=None):
+    """Adds new spikes to the extendable units group of an nwb file, after the spikes of the same nodes. The spikes
+    already in the group are read from it, unless it doesn't hold the spikes recorded in progress because its last
+    write was interrupted. It is then rebuilt from the sonata files recorded in progress, up to their recorded counts.
+    """
+    n_converted = sum(file_progress.get('spikes', 0) for file_progress in progress['files'].values())
+    index = units_grp['spike_times_index'][:]
+    if len(units_grp['spike_times']) == (index[-1] if len(index) else 0) == n_converted and \
+            len(units_grp['id']) == len(index):
+        converted_ids = np.repeat(units_grp['id'][:], np.diff(index, prepend=0).astype(int))
+        converted_timestamps = units_grp['spike_times'][:]
+    else:
+        converted_ids, converted_timestamps = __read_converted_spikes(progress, population)
+    __write_units(units_grp, np.concatenate((converted_ids, node_ids)),
+                  np.concatenate((converted_timestamps, timestamps)))
+
+
+def __read_converted_spikes(progress, population=None):
+    """Reads the spikes of every sonata file in progress, up to the number of spikes converted with it"""
+    node_ids, timestamps = [np.zeros(0, dtype=int)], [np.zeros(0)]
+    for file_name, file_progress in progress['files'].items():
+        n_spikes = file_progress.get('spikes', 0)
+        if n_spikes:
+            with h5py.File(file_name, 'r') as h5:
+                _, _, spikes_grp, _ = __parse_h5_tree(h5, file_name, population)
+                node_ids.append(spikes_grp['node_ids'][:n_spikes])
+                timestamps.append(spikes_grp['timestamps'][:n_spikes])
+    return np.concatenate(node_ids), np.concatenate(timestamps)
+
+
+def __write_units(units_grp, node_ids, timestamps):
+    """Overwrites the extendable units group of an nwb file with spikes, grouped by node in their original order"""
+    order = np.argsort(node_ids, kind='stable')
+    ids, counts = np.unique(node_ids, return_counts=True)
+    for dset_name, values in (('id', ids), ('spike_times', timestamps[order]),
+                              ('spike_times_index', np.cumsum(counts))):
+        units_grp[dset_name].resize(values.shape)
+        units_grp[dset_name][:] = values
+
+
+def __load_progress(progress_path):
+    if not os.path.exists(progress_path):
+        return {'files': dict(), 'segments': dict()}
+    with open(progress_path, 'r') as f:
+        progress = json.load(f)
+    progress.setdefault('segments', dict())
+    return progress
+
+
+def __save_progress(progress_path, progress):
+    # write to a temporary file first, so that the progress file is always complete
+    with open(progress_path + '.tmp', 'w') as f:
+        json.dump(progress, f, indent=2)
+    os.replace(progress_path + '.tmp', progress_path)
+
+
+def __read_sonata_file(file_name, population=None, stub=False, load_data=True, read_ecp=True, load_ecp=True,
+                       node_ids=None, compartments=None, time_range=None):
+    """Reads and preprocesses everything that is converted from a sonata file, without touching an NWBFile, so that
+    files can be read in parallel worker processes. Only the nodes, compartments and time range selected by node_ids,
+    compartments and time_range are read.
+
+    :return: dict with the 'reports' (list, with the report of every population and its 'population'), 'spikes' (by
+        population) and 'ecp' contents of the file (dicts of numpy arrays, see __read_report, __read_spikes and
+        __read_ecp), which are None for sections the file doesn't contain.
+    """
+    with h5py.File(file_name, 'r') as h5:
+        report_grps, spikes_grps, ecp_grp = __parse_h5_populations(h5, file_name, population)
+        # files with several populations are converted in one pass, with the population in each report and unit
+        reports = [dict(__read_report(report_grp, stub=stub, load_data=load_data,
+                                      node_ids=__get_population_node_ids(node_ids, pop), compartments=compartments,
+                                      time_range=time_range),
+                        population=pop)
+                   for pop, report_grp in report_grps.items()]
+        spikes = {pop: __read_spikes(spikes_grp, node_ids=__get_population_node_ids(node_ids, pop),
+                                     time_range=time_range)
+                  for pop, spikes_grp in spikes_grps.items()}
+        return {
+            'reports': reports,
+            'spikes': spikes or None,
+            'ecp': __read_ecp(ecp_grp, load_data=load_ecp, time_range=time_range) if ecp_grp and read_ecp else None,
+        }
+
+
+def __get_population_node_ids(node_ids, population):
+    """The node_ids selected in population, from the same node_ids for every population or from a dict of them by
+    population, where populations that are not in the dict have none selected"""
+    if isinstance(node_ids, dict):
+        return node_ids.get(population, ())
+    return node_ids
+
+
+def __parse_h5_populations(h5_handle, file_name, population=None):
+    """Like __parse_h5_tree, for all node populations of the file if population is None, or for a list of them.
+
+    :return: {population: /report/<population> (h5py.Group)}, {population: /spikes/<population> (h5py.Group)} and
+        /ecp (h5py.Group, or None if the file doesn't contain it).
+    """
+    groups = []
+    for report_type in ('report', 'spikes'):
+        grp_root = h5_handle[report_type] if report_type in h5_handle.keys() else dict()
+        pops = [k for k, g in grp_root.items() if isinstance(g, h5py.Group)]
+        selected = pops
+        if population is not None:
+            selected = [population] if isinstance(population, str) else list(population)
+            missing = [pop for pop in selected if pop not in pops]
+            if pops and missing:
+                raise Exception('Could not find node population group {} in {} (valid populations: {})'.format(
+                    ' '.join(missing), file_name, ' '.join(pops)))
+        groups.append({pop: grp_root[pop] for pop in selected if pop in pops})
+
+    ecp_handle = h5_handle['ecp'] if isinstance(h5_handle.get('ecp'), h5py.Group) else None
+    return groups[0], groups[1], ecp_handle
+
 
 def __parse_h5_tree(h5_handle, file_name, population=None):
     """Parses the hdf5 file for the appropiate groups containing /report/<population>, /spikes/<population> and /ecp for
@@ -197,16 +887,21 @@ def __parse_h5_tree(h5_handle, file_name, population=None):
 
 
 def __add_continuous_compartments_helper(nwbfile, h5_grp, population_name=None, name='membrane_potential', unit='mV',
-                                         stub=False):
+                                         stub=False, buffer_gb=None, data_io_kwargs=None):
     """Helper function for parsing a /report/<population>/ sonata group and coverting into a nwb Compartments table"""
-    data = h5_grp['data'][:10] if stub else h5_grp['data'][:]
+    report = __read_report(h5_grp, unit=unit, stub=stub, load_data=buffer_gb is None)
+    return __add_report(nwbfile, report, dataset=h5_grp['data'], name=name, buffer_gb=buffer_gb,
+                        data_io_kwargs=data_io_kwargs)
+
+
+def __read_report(h5_grp, unit='mV', stub=False, load_data=True, node_ids=None, compartments=None, time_range=None):
+    """Reads the mapping of a /report/<population>/ sonata group, and the data unless load_data is False, in which case
+    the data has to be streamed from data_path of file_name when it is written. If node_ids, compartments or
+    time_range are specified, the mapping only has the selected compartments, and the data (read or streamed) only
+    the time steps in rows and the columns in columns."""
     unit = __get_attrs(h5_grp['data'], 'units', unit)  # See if the units attributes exists, otherwise use the default.
 
     mapping = h5_grp['mapping']
-    elem_ids = mapping['element_ids'][:]
-    elem_pos = mapping['element_pos'][:]
-    index_pointer = mapping['index_pointer'][:]
-    node_ids = mapping['node_ids'][:]
     start, stop, timestep = mapping['time'][:]
     time_units = __get_attrs(mapping['time'], 'units', 'ms').lower()
     if time_units == 's':
@@ -214,43 +909,294 @@ def __add_continuous_compartments_helper(nwbfile, h5_grp, population_name=None,
     else:
         t_conv = 1.0/1000.0
 
-    compartments = Compartments()
-    nwbfile.add_lab_meta_data(SimulationMetaData(compartments=compartments))
+    rows = __select_time_steps(h5_grp['data'].shape[0], start, timestep, time_range)
+    if stub:
+        rows = slice(rows.start, min(rows.stop, rows.start + 10))
+
+    report = {
+        'file_name': h5_grp.file.filename,
+        'data_path': h5_grp['data'].name,
+        'unit': unit,
+        'rate': 1 / (timestep*t_conv),
+        'starting_time': (start + rows.start * timestep) * t_conv,
+        'element_ids': mapping['element_ids'][:],
+        'element_pos': mapping['element_pos'][:],
+        'index_pointer': mapping['index_pointer'][:],
+        'node_ids': mapping['node_ids'][:],
+        'rows': rows,
+        'columns': None,
+    }
+    if node_ids is not None or compartments is not None:
+        report = __select_compartments(report, node_ids, compartments)
+
+    report['data'] = _read_selection(h5_grp['data'], rows, report['columns']) if stub or load_data else None
+    return report
+
+
+def __select_time_steps(n_times, start, timestep, time_range=None):
+    """Returns the slice of the n_times time steps (of start + i * timestep) within time_range, [start, stop)"""
+    if time_range is None:
+        return slice(0, n_times)
+    # round to avoid losing time steps that are at the edges up to floating point errors
+    first, stop = [min(max(int(np.ceil(np.round((t - start) / timestep, 9))), 0), n_times) for t in time_range]
+    return slice(first, max(first, stop))
+
 
-    for i_start, i_stop, node_id in tqdm(zip(index_pointer,
-                                             index_pointer[1:], node_ids),
-                                         total=len(node_ids),
-                                         desc='reading continuous data'):
-        compartments.add_row(id=int(node_id),
-                             number=elem_ids[i_start:i_stop].astype('int'),
-                             position=elem_pos[i_start:i_stop])
+def __select_compartments(report, node_ids=None, compartments=None):
+    """Returns a copy of a report read by __read_report with the mapping of the compartments of node_ids with numbers
+    (element ids) in compartments only, and the indices of their columns in the data"""
+    index_pointer = report['index_pointer']
+    n_compartments = np.diff(index_pointer).astype(int)
+    node_index = np.repeat(np.arange(len(n_compartments)), n_compartments)
+    columns = np.arange(index_pointer[0], index_pointer[-1])
+
+    selected = np.ones(len(columns), dtype=bool)
+    if node_ids is not None:
+        selected &= np.isin(report['node_ids'], np.asarray(list(node_ids)))[node_index]
+    if compartments is not None:
+        selected &= np.isin(report['element_ids'][columns], np.asarray(list(compartments)))
+    counts = np.bincount(node_index[selected], minlength=len(n_compartments))
+    columns = columns[selected]
+
+    return dict(report, node_ids=report['node_ids'][counts > 0],
+                index_pointer=np.r_[0, np.cumsum(counts[counts > 0])].astype(index_pointer.dtype),
+                element_ids=report['element_ids'][columns], element_pos=report['element_pos'][columns],
+                columns=columns)
+
+
+def __add_report(nwbfile, report, dataset=None, name='membrane_potential', buffer_gb=None, data_io_kwargs=None,
+                 statistics=None, extendable=False, encoding=None, data_io=H5DataIO):
+    """Adds a report read by __read_report to the nwbfile as a CompartmentSeries. If the data of the report was not
+    loaded, it is streamed from dataset (h5py.Dataset) in blocks of at most buffer_gb. If statistics
+    (SummaryStatistics) is specified, it is updated with the data, for streamed data only once the nwbfile is written.
+    If extendable, the data is written empty, with the shape and dtype of dataset and an unlimited time axis. The data
+    is stored with encoding (dict of the arguments of __get_encoder) and written with data_io (H5DataIO or
+    ZarrDataIO). A selection without time steps or compartments is written empty, without streaming."""
+    index_pointer = report['index_pointer']
+    data = report['data'] if report['data'] is not None else dataset
+    if report['data'] is None:
+        shape = (len(range(*report['rows'].indices(dataset.shape[0]))),
+                 len(report['columns']) if report['columns'] is not None else dataset.shape[1])
+    else:
+        shape = data.shape
+    if report['data'] is None and not all(shape):
+        data = np.empty(shape, dtype=dataset.dtype)
+        report = dict(report, data=data)
+    encode, encoding_kwargs = __get_encoder(**(encoding or dict()))
+    dtype = encode(data[:0]).dtype if encode is not None else data.dtype
+
+    data_io_kwargs = dict(data_io_kwargs or dict())
+    if 'chunks' in data_io_kwargs:
+        chunks = data_io_kwargs.pop('chunks')
+    else:
+        chunks = __get_compartment_chunk_shape(shape, dtype.itemsize, index_pointer)
+    if extendable:
+        data = H5DataIO(shape=(0,) + shape[1:], dtype=dtype, maxshape=(None,) + shape[1:],
+                        chunks=chunks, **data_io_kwargs)
+    elif report['data'] is None:
+        block_callback = statistics.update if statistics is not None else None
+        selection = dict(rows=report['rows'], columns=report['columns'])
+        if isinstance(chunks, (tuple, list)):
+            data = SonataDataChunkIterator(data, buffer_gb=buffer_gb, chunk_shape=tuple(chunks),
+                                           block_callback=block_callback, transform=encode, **selection)
+        else:
+            data = SonataDataChunkIterator(data, buffer_gb=buffer_gb, block_callback=block_callback,
+                                           transform=encode, **selection)
+    else:
+        if statistics is not None:
+            statistics.update(data)
+        if encode is not None:
+            data = encode(data)
+    if not extendable:
+        if chunks is True and data_io is not H5DataIO:
+            chunks = None  # let zarr choose
+        data = data_io(data, chunks=chunks, **data_io_kwargs)
+
+    compartments = __get_compartments(nwbfile, report)
 
     cs = CompartmentSeries(name, data,
                            compartments=compartments,
-                           unit=unit, rate=1 / (timestep*t_conv))
+                           unit=report['unit'], rate=report['rate'], starting_time=report['starting_time'],
+                           **encoding_kwargs)
 
     nwbfile.add_acquisition(cs)
 
     return nwbfile
 
 
+def __get_encoder(dtype=None, resolution=None, offset=0.):
+    """Returns a function that converts blocks of report data to the dtype they are stored with, or to int16 steps of
+    resolution above offset, and the conversion, offset and resolution of the CompartmentSeries that map the stored
+    values back to the unit of the report. The function is None if the data is stored as it is."""
+    if resolution is not None:
+        return partial(__quantize, resolution=resolution, offset=offset), \
+            dict(conversion=float(resolution), offset=float(offset), resolution=float(resolution))
+    if dtype is not None:
+        return partial(np.asarray, dtype=np.dtype(dtype)), dict()
+    return None, dict()
+
+
+def __quantize(block, resolution, offset=0.):
+    """Linear quantization of block to int16 steps of resolution above offset"""
+    steps = np.rint((np.asarray(block, dtype=float) - offset) / resolution)
+    limits = np.iinfo(np.int16)
+    if steps.size and (steps.min() < limits.min or steps.max() > limits.max):
+        warnings.warn('Values outside of [{}, {}] are clipped, use a larger resolution to store them.'.format(
+            offset + limits.min * resolution, offset + limits.max * resolution))
+    return np.clip(steps, limits.min, limits.max).astype(np.int16)
+
+
+def __get_compartments(nwbfile, report):
+    """Returns the Compartments table of the population of the report in the nwbfile, creating it from the mapping of
+    the report if it doesn't exist yet. Reports of the same simulation (e.g. membrane potential and calcium
+    concentration) share the table, which is named compartments, or compartments_<population> when reports of several
+    populations are converted."""
+    name = 'compartments_{}'.format(report['population']) if report.get('population') is not None else 'compartments'
+    simulation = nwbfile.lab_meta_data.get('simulation')
+    if simulation is None or name not in simulation.compartments_tables:
+        compartments = Compartments.from_csr(report['element_ids'], report['index_pointer'], name=name,
+                                             position=report['element_pos'], id=report['node_ids'])
+        if simulation is None:
+            nwbfile.add_lab_meta_data(SimulationMetaData(compartments=compartments))
+        else:
+            simulation.add_compartments(compartments)
+        return compartments
+
+    compartments = simulation.get_compartments(name)
+    index_pointer = report['index_pointer']
+    if not (np.array_equal(compartments.id.data, report['node_ids']) and
+            np.array_equal(compartments['number_index'].data, index_pointer[1:] - index_pointer[0]) and
+            np.array_equal(compartments['number'].target.data,
+                           report['element_ids'][index_pointer[0]:index_pointer[-1]])):
+        raise ValueError('The mapping of {} does not match the compartments of the reports that were already '
+                         'converted'.format(report['file_name']))
+    return compartments
+
+
 def __add_spikes_helper(nwbfile, h5_handle, population=None):
     """Parse the sonata /spikes/<population> group and add the units + spike times to the nwb file"""
-    node_ids = h5_handle['node_ids'][:]
-    timestamps = h5_handle['timestamps'][:]
+    return __add_units(nwbfile, __read_spikes(h5_handle))
+
+
+def __read_spikes(h5_handle, node_ids=None, time_range=None):
+    """Reads a /spikes/<population> group and groups the spikes by node. Returns a dict with the unit_ids, the
+    timestamps of all units concatenated, and the stops of the spikes of each unit in timestamps. If specified, only
+    the spikes of node_ids within time_range, [start, stop) in the time units of the file, are returned."""
+    spikes = slice(None)
+    if time_range is not None and __get_attrs(h5_handle, 'sorting') == 'by_time':
+        # only read the spikes within the window, found by bisection of the timestamps in the file
+        spikes = slice(*[__search_sorted(h5_handle['timestamps'], t) for t in time_range])
+    selected_node_ids = node_ids
+    node_ids = h5_handle['node_ids'][spikes]
+    timestamps = h5_handle['timestamps'][spikes]
+
+    selected = np.ones(len(node_ids), dtype=bool)
+    if selected_node_ids is not None:
+        selected &= np.isin(node_ids, np.asarray(list(selected_node_ids)))
+    if time_range is not None:
+        selected &= (timestamps >= time_range[0]) & (timestamps < time_range[1])
+    if not selected.all():
+        node_ids, timestamps = node_ids[selected], timestamps[selected]
+
+    # Group the spikes by node with a single stable sort, which keeps the spikes of each node in their original order.
+    # Files sorted by_id are already grouped.
+    if __get_attrs(h5_handle, 'sorting') != 'by_id':
+        order = np.argsort(node_ids, kind='stable')
+        node_ids = node_ids[order]
+        timestamps = timestamps[order]
+    is_first = np.ones(len(node_ids), dtype=bool)
+    is_first[1:] = node_ids[1:] != node_ids[:-1]
+    starts = np.flatnonzero(is_first)
 
-    for i in tqdm(np.unique(node_ids), desc='reading units'):
-        nwbfile.add_unit(spike_times=timestamps[node_ids == i], id=int(i))
+    return {
+        'unit_ids': node_ids[starts].astype(int),
+        'timestamps': timestamps,
+        'stops': np.r_[starts[1:], len(node_ids)].astype(int) if len(node_ids) else starts.astype(int),
+    }
+
+
+def __merge_spikes(spikes):
+    """Concatenates spikes read by __read_spikes of several files or populations ([(population, spikes)]), with the
+    population of every unit if they are of several populations"""
+    if len(spikes) == 1:
+        return spikes[0][1]
+    starts = np.cumsum([0] + [len(pop_spikes['timestamps']) for _, pop_spikes in spikes])
+    merged = {
+        'unit_ids': np.concatenate([pop_spikes['unit_ids'] for _, pop_spikes in spikes]),
+        'timestamps': np.concatenate([pop_spikes['timestamps'] for _, pop_spikes in spikes]),
+        'stops': np.concatenate([pop_spikes['stops'] + start for (_, pop_spikes), start in zip(spikes, starts)]),
+    }
+    if len({pop for pop, _ in spikes}) > 1:
+        merged['population'] = np.concatenate([np.full(len(pop_spikes['unit_ids']), pop, dtype=object)
+                                               for pop, pop_spikes in spikes])
+    return merged
+
+
+def __search_sorted(dataset, value):
+    """Index of the first element of a sorted 1D h5py.Dataset that is not less than value, reading log2(n) elements"""
+    low, high = 0, len(dataset)
+    while low < high:
+        middle = (low + high) // 2
+        if dataset[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def __add_units(nwbfile, spikes, extendable=False):
+    """Adds spikes read by __read_spikes (or merged by __merge_spikes, with a population column) to the units of the
+    nwbfile. If extendable, the units table is created with an unlimited number of units and spikes."""
+    unit_ids, timestamps, stops = spikes['unit_ids'], spikes['timestamps'], spikes['stops']
+    populations = spikes.get('population')
+
+    if nwbfile.units is None:
+        if extendable:
+            unit_ids, timestamps, stops = [H5DataIO(values, maxshape=(None,), chunks=True)
+                                           for values in (unit_ids, timestamps, stops)]
+        # fill the Units table in bulk, straight from the flat spike times and the offsets of each unit
+        spike_times = VectorData(name='spike_times', description='the spike times for each unit', data=timestamps)
+        spike_times_index = VectorIndex(name='spike_times_index', data=stops, target=spike_times)
+        columns = [spike_times, spike_times_index]
+        if populations is not None:
+            columns.append(VectorData(name='population', description='node population of the unit',
+                                      data=list(populations)))
+        nwbfile.units = Units(name='units', id=unit_ids, columns=columns,
+                              description='units simulated in the network')
+    else:
+        # extend the flat columns in bulk, with the offsets of the new units after the spikes already in the table
+        units = nwbfile.units
+        spike_times_index = units['spike_times']
+        new_values = [(units.id, unit_ids), (spike_times_index.target, timestamps),
+                      (spike_times_index, stops + len(spike_times_index.target.data))]
+        if 'population' in units.colnames:
+            if populations is None:
+                populations = np.full(len(unit_ids), '', dtype=object)
+            new_values.append((units['population'], populations))
+        for column, values in new_values:
+            column.transform(lambda data, values=values: __extend(data, values))
 
     return nwbfile
 
 
-def __add_electrodes_helper(nwbfile, h5_grp, positions_csv):
-    electrodes_df = pd.read_csv(positions_csv, sep=' ')
+def __extend(data, values):
+    """Appends values to the data of a column. extend_data of hdmf stacks numpy arrays as rows, so 1D arrays are
+    concatenated instead."""
+    if isinstance(data, np.ndarray):
+        return np.concatenate((data, values))
+    return extend_data(data, list(values))
+
+
+def __add_electrodes_helper(nwbfile, h5_grp, positions_csv, data_io_kwargs=None, buffer_gb=None):
+    return __add_ecp(nwbfile, __read_ecp(h5_grp, load_data=buffer_gb is None), positions_csv,
+                     data_io_kwargs=data_io_kwargs, dataset=h5_grp['data'], buffer_gb=buffer_gb)
 
-    electrode_ids = h5_grp['channel_id'][:]
-    data = h5_grp['data'][:]
+
+def __read_ecp(h5_grp, load_data=True, time_range=None):
+    """Reads the channels, data (unless load_data is False) and timing of an /ecp sonata group, within time_range if
+    specified"""
     start, stop, timestep = h5_grp['time'][:]
+    rows = __select_time_steps(h5_grp['data'].shape[0], start, timestep, time_range)
 
     # Check sonata file attributes for time units
     time_units = __get_attrs(h5_grp['time'], 'units', 'ms').lower()
@@ -259,25 +1205,100 @@ def __add_electrodes_helper(nwbfile, h5_grp, positions_csv):
     else:
         t_conv = 1.0/1000.0
 
+    return {
+        'channel_ids': h5_grp['channel_id'][:],
+        'data': h5_grp['data'][rows] if load_data else None,
+        'shape': (rows.stop - rows.start,) + h5_grp['data'].shape[1:],
+        'dtype': h5_grp['data'].dtype,
+        'starting_time': (start + rows.start * timestep) * t_conv,
+        'rate': 1 / (timestep*t_conv),
+        'rows': rows,
+    }
+
+
+def __add_ecp(nwbfile, ecp, positions_csv, data_io_kwargs=None, extendable=False, data_io=H5DataIO, dataset=None,
+              buffer_gb=None):
+    """Adds the electrodes in positions_csv and the ECP read by __read_ecp to the nwbfile. If extendable, the data is
+    written empty, with the shape and dtype of the ECP and an unlimited time axis. If the data of the ECP was not
+    loaded, it is streamed from dataset (h5py.Dataset) in blocks of at most buffer_gb, and of whole chunks if
+    data_io_kwargs has a chunk shape, unless no time steps are selected. Otherwise data_io_kwargs are fed into data_io
+    (H5DataIO or ZarrDataIO)."""
+    data = ecp['data']
+    data_io_kwargs = dict(data_io_kwargs or dict())
+    if extendable:
+        n_channels = ecp['shape'][1]
+        data = H5DataIO(shape=(0, n_channels), dtype=ecp['dtype'], maxshape=(None, n_channels),
+                        **dict(dict(chunks=True), **data_io_kwargs))
+    elif data is None and not all(ecp['shape']):
+        data = data_io(np.empty(ecp['shape'], dtype=ecp['dtype']), **data_io_kwargs)
+    elif data is None:
+        chunks = data_io_kwargs.get('chunks')
+        chunk_kwargs = dict(chunk_shape=tuple(chunks)) if isinstance(chunks, (tuple, list)) else dict()
+        data = data_io(SonataDataChunkIterator(dataset, buffer_gb=buffer_gb or 1.0, rows=ecp['rows'], **chunk_kwargs),
+                       **data_io_kwargs)
+    elif data_io_kwargs:
+        data = data_io(data, **data_io_kwargs)
+
     device = nwbfile.create_device('simulated_implant')
     electrode_group = nwbfile.create_electrode_group(
         'simulated_implant', 'description', 'unknown', device)
+    nwbfile.electrodes = __create_electrode_table(pd.read_csv(positions_csv, sep=' '), electrode_group)
 
-    for (id, x, y, z) in electrodes_df.values:
-        nwbfile.add_electrode(x=x, y=y, z=z, imp=np.nan, id=int(id),
-                              location='unknown', filtering='none',
-                              group=electrode_group)
-
-    match_electrodes = [np.where(electrode_ids == x)[0] for x in electrodes_df['channel']]
+    # the row of the electrode table of every channel (column) of the data, by a binary search of the sorted ids
+    table_ids = np.asarray(nwbfile.electrodes.id.data)
+    order = np.argsort(table_ids, kind='stable')
+    positions = np.searchsorted(table_ids, ecp['channel_ids'], sorter=order).clip(max=len(order) - 1)
+    rows = order[positions]
+    if not np.array_equal(table_ids[rows], ecp['channel_ids']):
+        missing = np.setdiff1d(ecp['channel_ids'], table_ids)
+        raise ValueError('The channels {} of the ECP are not in {}'.format(missing.tolist(), positions_csv))
 
-    electrodes = nwbfile.create_electrode_table_region(match_electrodes, 'all electrodes')
+    electrodes = nwbfile.create_electrode_table_region(rows.tolist(), 'all electrodes')
 
     nwbfile.add_acquisition(
-        ElectricalSeries('ElectricalSeries', data, starting_time=start*t_conv,
-                         rate=1 / (timestep*t_conv), electrodes=electrodes))
+        ElectricalSeries('ElectricalSeries', data, starting_time=ecp['starting_time'],
+                         rate=ecp['rate'], electrodes=electrodes))
     return nwbfile
 
 
+def __create_electrode_table(electrodes_df, electrode_group):
+    """Builds the electrode table of the channels in electrodes_df (the channel, x, y and z columns of a SONATA
+    electrodes csv) in bulk, with one column per field instead of one add_electrode call per channel"""
+    n_electrodes = len(electrodes_df)
+    ids, x, y, z = [electrodes_df.iloc[:, i].values for i in range(4)]
+    columns = [
+        VectorData(name='location', description='the location of channel within the subject e.g. brain region',
+                   data=['unknown'] * n_electrodes),
+        VectorData(name='group', description='a reference to the ElectrodeGroup this electrode is a part of',
+                   data=[electrode_group] * n_electrodes),
+        VectorData(name='group_name', description='the name of the ElectrodeGroup this electrode is a part of',
+                   data=[electrode_group.name] * n_electrodes),
+        VectorData(name='x', description='the x coordinate of the channel location', data=x.astype(float)),
+        VectorData(name='y', description='the y coordinate of the channel location', data=y.astype(float)),
+        VectorData(name='z', description='the z coordinate of the channel location', data=z.astype(float)),
+        VectorData(name='imp', description='the impedance of the channel', data=np.full(n_electrodes, np.nan)),
+        VectorData(name='filtering', description='description of hardware filtering',
+                   data=['none'] * n_electrodes),
+    ]
+    return DynamicTable(name='electrodes', description='metadata about extracellular electrodes',
+                        id=ids.astype(int), columns=columns)
+
+
+def __get_compartment_chunk_shape(shape, itemsize, index_pointer, chunk_mb=1.0):
+    """Chunk shape for a (time x compartments) report. The compartments of a cell are stored in adjacent columns, so a
+    chunk spans as many columns as 90% of the cells have compartments at most, and as many time steps as fit in
+    chunk_mb. Reading one of these cells over a window of time then only touches one or two chunks per block of time
+    steps, while a few very large cells don't make the chunks of all others wide. Empty data is not chunked."""
+    n_rows, n_cols = shape
+    if not n_rows or not n_cols:
+        return None
+    compartments_per_cell = np.diff(index_pointer)
+    chunk_cols = int(np.percentile(compartments_per_cell, 90)) if len(compartments_per_cell) else n_cols
+    chunk_cols = min(max(chunk_cols, 1), n_cols)
+    chunk_rows = int(chunk_mb * 1e6 // (chunk_cols * itemsize))
+    return min(max(chunk_rows, 1), n_rows), chunk_cols
+
+
 def __get_attrs(h5_obj, attr_key, default=None):
     """Helper function to make sure attribute values in h5py are returned as strings and not bytes."""
     val = h5_obj.attrs.get(attr_key, default)
@@ -0,0 +1,109 @@
+import numpy as np
+from hdmf.common.table import DynamicTable, VectorData
+from pynwb import NWBHDF5IO
+
+
+class SummaryStatistics(object):
+    """Accumulates the mean, std, min, max and number of upward threshold crossings of every column of a (time x
+    compartments) matrix that is passed in consecutive blocks of time steps, optionally of some of the columns at a
+    time. Means and variances of the blocks are merged with Chan's parallel algorithm, which is numerically stable for
+    any number of blocks."""
+
+    def __init__(self, threshold=None):
+        """
+
+        Parameters
+        ----------
+        threshold: float, optional
+            If specified, count how often each column goes from below threshold to at or above it.
+
+        """
+        self.threshold = threshold
+        self.count = np.zeros(0, dtype=int)
+        self.crossings = np.zeros(0, dtype=int)
+        self.mean, self.m2, self.min, self.max = np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
+        self.__last_row = np.zeros((1, 0))
+
+    def __resize(self, n_columns):
+        """Add columns up to n_columns, as columns without any time steps"""
+        n_new = n_columns - len(self.count)
+        if n_new <= 0:
+            return
+        self.count = np.r_[self.count, np.zeros(n_new, dtype=int)]
+        self.crossings = np.r_[self.crossings, np.zeros(n_new, dtype=int)]
+        self.mean = np.r_[self.mean, np.zeros(n_new)]
+        self.m2 = np.r_[self.m2, np.zeros(n_new)]
+        self.min = np.r_[self.min, np.full(n_new, np.inf)]
+        self.max = np.r_[self.max, np.full(n_new, -np.inf)]
+        # nan marks columns without a previous time step
+        self.__last_row = np.hstack((self.__last_row, np.full((1, n_new), np.nan)))
+
+    def update(self, block, columns=None):
+        """Add the next block of time steps (time x compartments) of all columns, or of the columns (slice) of the
+        data. The blocks of each column have to be passed in order of time."""
+        block = np.asarray(block, dtype=float)
+        if not len(block):
+            return
+        columns = columns if columns is not None else slice(0, block.shape[1])
+        self.__resize(columns.stop)
+        block_count = len(block)
+        block_mean = block.mean(axis=0)
+        block_m2 = ((block - block_mean) ** 2).sum(axis=0)
+
+        previous_count = self.count[columns]
+        count = previous_count + block_count
+        delta = block_mean - self.mean[columns]
+        self.mean[columns] += delta * block_count / count
+        self.m2[columns] += block_m2 + delta ** 2 * previous_count * block_count / count
+        self.min[columns] = np.minimum(self.min[columns], block.min(axis=0))
+        self.max[columns] = np.maximum(self.max[columns], block.max(axis=0))
+        self.count[columns] = count
+
+        if self.threshold is not None:
+            # include the crossing between the last time step of the previous block and the first of this one
+            above = np.vstack((self.__last_row[:, columns], block)) >= self.threshold
+            first = np.isnan(self.__last_row[0, columns])
+            above[0, first] = above[1, first]
+            self.crossings[columns] += np.count_nonzero(above[1:] & ~above[:-1], axis=0)
+        self.__last_row[:, columns] = block[-1:]
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count.all() else None
+
+    def to_table(self, name, description=None):
+        """A DynamicTable with one row per column of the data and the columns mean, std, min, max and, if a threshold
+        was specified, threshold_crossings"""
+        columns = [VectorData(name='mean', description='mean over time', data=self.mean),
+                   VectorData(name='std', description='standard deviation over time', data=self.std),
+                   VectorData(name='min', description='minimum over time', data=self.min),
+                   VectorData(name='max', description='maximum over time', data=self.max)]
+        if self.threshold is not None:
+            columns.append(VectorData(name='threshold_crossings',
+                                      description='number of upward crossings of {}'.format(self.threshold),
+                                      data=self.crossings))
+        return DynamicTable(name=name, columns=columns, id=np.arange(len(self.mean)),
+                            description=description or 'summary statistics of each column of the data')
+
+
+def add_summary(nwb_path, series_name, statistics, module_name='summary'):
+    """Write the statistics accumulated over the data of a CompartmentSeries to an NWB file, as a table named
+    <series_name>_summary with one row per column of the data, in a processing module.
+
+    Parameters
+    ----------
+    nwb_path: str
+    series_name: str
+    statistics: SummaryStatistics
+    module_name: str, optional
+
+    """
+    with NWBHDF5IO(nwb_path, 'a') as io:
+        nwbfile = io.read()
+        if module_name in nwbfile.processing:
+            module = nwbfile.processing[module_name]
+        else:
+            module = nwbfile.create_processing_module(module_name, 'summary statistics of continuous data')
+        module.add(statistics.to_table('{}_summary'.format(series_name),
+                                       'summary statistics of each column of {}'.format(series_name)))
+        io.write(nwbfile)
@@ -5,27 +5,45 @@ from h5py import File
 from pynwb import NWBHDF5IO
 
 
-def nwb2sonata(nwb_path, save_dir):
+def nwb2sonata(nwb_path, save_dir, buffer_gb=1.0, dataset_kwargs=None):
     """Example of a conversion from from NWB to SONATA
 
     Parameters
     ----------
     nwb_path: str
+        NWB file, or Zarr directory store (read with hdmf_zarr)
     save_dir: str
+    buffer_gb: float, optional
+        Maximum amount of data (in GB) read into memory at a time when copying the continuous data.
+    dataset_kwargs: dict, optional
+        Options for creating the SONATA data datasets, keyed by the name of the series ('ElectricalSeries',
+        'membrane_potential'). The values are dicts fed into h5py.Group.create_dataset, e.g.
+        {'membrane_potential': {'compression': 'gzip', 'chunks': (1000, 100)}}.
 
     """
+    dataset_kwargs = dataset_kwargs or dict()
 
-    with NWBHDF5IO(nwb_path, 'r') as io:
+    with open_nwb(nwb_path, 'r') as io:
         os.mkdir(save_dir)
         nwb = io.read()
         export_spikes(nwb.units, save_dir)
         export_electrode_positions(nwb.electrodes, save_dir)
-        export_electrode_recordings(nwb.acquisition['ElectricalSeries'], save_dir)
-        export_membrane_potential(nwb.acquisition['membrane_potential'], save_dir)
+        export_electrode_recordings(nwb.acquisition['ElectricalSeries'], save_dir, buffer_gb=buffer_gb,
+                                    dataset_kwargs=dataset_kwargs.get('ElectricalSeries'))
+        export_membrane_potential(nwb.acquisition['membrane_potential'], save_dir, buffer_gb=buffer_gb,
+                                  dataset_kwargs=dataset_kwargs.get('membrane_potential'))
 
     print('done.')
 
 
+def open_nwb(nwb_path, mode='r'):
+    """NWBHDF5IO for an HDF5 file, or NWBZarrIO (from hdmf_zarr) for a Zarr directory store"""
+    if os.path.isdir(nwb_path):
+        from hdmf_zarr.nwb import NWBZarrIO
+        return NWBZarrIO(nwb_path, mode)
+    return NWBHDF5IO(nwb_path, mode)
+
+
 def convert_time(group, time_series):
     """
 
@@ -48,7 +66,48 @@ def convert_time(group, time_series):
     return time_dset
 
 
-def export_spikes(units, save_dir, save_fname='spikes.h5'):
+def write_blocks(group, name, data, dtype, buffer_gb=1.0, scale=None, offset=None, **kwargs):
+    """Copy data into a new dataset block by block along the first (time) axis, so that at most buffer_gb of data is
+    held in memory at a time.
+
+    Parameters
+    ----------
+    group: h5py.Group
+    name: str
+        name of the new dataset
+    data: array-like
+        e.g. an h5py.Dataset read from an NWB file
+    dtype: numpy.dtype
+        dtype of the new dataset
+    buffer_gb: float, optional
+    scale: float, optional
+        if specified, every block is multiplied by scale (e.g. to convert units) before being written
+    offset: float, optional
+        if specified, added to every block after scale (e.g. the offset of quantized data)
+    kwargs: fed into h5py.Group.create_dataset (e.g. chunks, compression, compression_opts, shuffle, maxshape)
+
+    Returns
+    -------
+    h5py.Dataset
+
+    """
+    dtype = np.dtype(dtype)
+    dset = group.create_dataset(name, shape=data.shape, dtype=dtype, **kwargs)
+
+    row_bytes = max(int(np.prod(data.shape[1:])), 1) * dtype.itemsize
+    n_rows = max(int(buffer_gb * 1e9 // row_bytes), 1)
+    for start in range(0, data.shape[0], n_rows):
+        block = np.array(data[start:start + n_rows], dtype=dtype)
+        if scale is not None:
+            block *= scale
+        if offset is not None:
+            block += offset
+        dset[start:start + len(block)] = block
+
+    return dset
+
+
+def export_spikes(units, save_dir, save_fname='spikes.h5', sorting='by_time'):
     """read spike times from an NWB file and outputs them to a SONATA spikes file
 
     Parameters
@@ -56,21 +115,31 @@ def export_spikes(units, save_dir, save_fname='spikes.h5'):
     units: pynwb.Units
     save_dir: str
     save_fname: str, optional
+    sorting: str, optional
+        Order of the spikes in the SONATA file: 'by_time', 'by_id' or 'none' (the order of the Units table, which
+        needs no sorting at all).
 
     """
+    if sorting not in ('by_time', 'by_id', 'none'):
+        raise ValueError("sorting must be one of 'by_time', 'by_id' or 'none', got '{}'".format(sorting))
+
     save_fpath = os.path.join(save_dir, save_fname)
 
-    tt = units['spike_times'].target.data[:]
-    index_array = np.argsort(tt)
+    spike_times_index = units['spike_times']
+    tt = spike_times_index.target.data[:]
+    offsets = np.asarray(spike_times_index.data[:], dtype=int)
+    nodes = np.repeat(np.asarray(units.id.data[:]), np.diff(offsets, prepend=0))
 
-    indexes = units['spike_times'].data
-    nodes = np.zeros((indexes[0],))
-    for i, (x, y) in enumerate(zip(indexes, indexes[1:])):
-        nodes = np.hstack((nodes, np.ones((y - x,)) * (i + 1))).astype('int')
+    if sorting == 'by_time':
+        index_array = np.argsort(tt, kind='stable')
+    elif sorting == 'by_id' and np.any(np.diff(nodes) < 0):
+        index_array = np.argsort(nodes, kind='stable')
+    else:
+        index_array = slice(None)
 
     with File(save_fpath, 'w') as file:
         group = file.create_group('spikes/internal')
-        group.attrs['sorting'] = 'by_time'
+        group.attrs['sorting'] = sorting
         group.create_dataset('node_ids', dtype='uint64', data=nodes[index_array])
         timestamps_dset = group.create_dataset('timestamps', dtype='float', data=tt[index_array])
         timestamps_dset.attrs['units'] = 'ms'
@@ -95,7 +164,7 @@ def export_electrode_positions(electrodes, save_dir, save_fname='electrodes_300c
     df.to_csv(fpath, sep=' ')
 
 
-def export_electrode_recordings(electrical_series, save_dir, save_fname='ecp.h5'):
+def export_electrode_recordings(electrical_series, save_dir, save_fname='ecp.h5', buffer_gb=1.0, dataset_kwargs=None):
     """
 
     Parameters
@@ -103,22 +172,29 @@ def export_electrode_recordings(electrical_series, save_dir, save_fname='ecp.h5'
     electrical_series: pynwb.ElectricalSeries
     save_dir: str
     save_fname: str, optional
+    buffer_gb: float, optional
+        Maximum amount of data (in GB) read into memory at a time.
+    dataset_kwargs: dict, optional
+        Fed into h5py.Group.create_dataset for the data, e.g. {'compression': 'gzip', 'chunks': (1000, 64)}
 
     """
 
     fpath = os.path.join(save_dir, save_fname)
+    data_kwargs = dict(maxshape=(None, electrical_series.data.shape[1]))
+    data_kwargs.update(dataset_kwargs or dict())
 
     with File(fpath, 'w') as file:
         group = file.create_group('ecp')
         group.create_dataset('channel_id', dtype='int64', data=electrical_series.electrodes.data[:].ravel())
-        data_dset = group.create_dataset(
-            'data', dtype='float32', maxshape=(None, electrical_series.data.shape[1]), data=electrical_series.data[:] * 1000)
+        data_dset = write_blocks(group, 'data', electrical_series.data, 'float32', buffer_gb=buffer_gb, scale=1000,
+                                 **data_kwargs)
         data_dset.attrs['units'] = 'mV'
 
         convert_time(group, electrical_series)
 
 
-def export_membrane_potential(membrane_potential, save_dir, save_fname='membrane_potential.h5'):
+def export_membrane_potential(membrane_potential, save_dir, save_fname='membrane_potential.h5', buffer_gb=1.0,
+                              dataset_kwargs=None, dtype=None):
     """
 
     Parameters
@@ -126,15 +202,29 @@ def export_membrane_potential(membrane_potential, save_dir, save_fname='membrane
     membrane_potential: ndx_simulation_output.CompartmentSeries
     save_dir: str
     save_fname: str, optional
+    buffer_gb: float, optional
+        Maximum amount of data (in GB) read into memory at a time.
+    dataset_kwargs: dict, optional
+        Fed into h5py.Group.create_dataset for the data, e.g. {'compression': 'gzip', 'chunks': (1000, 100)}
+    dtype: numpy.dtype, optional
+        dtype of the SONATA data. Defaults to the dtype of the series if it is a float (e.g. float32), else float32.
+        The conversion and offset of the series (e.g. of quantized int16 data) are applied.
 
     """
     fpath = os.path.join(save_dir, save_fname)
+    if dtype is None:
+        dtype = membrane_potential.data.dtype
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.float32
+    scale = membrane_potential.conversion if membrane_potential.conversion != 1. else None
+    offset = membrane_potential.offset or None
+    data_kwargs = dict(chunks=True)
+    data_kwargs.update(dataset_kwargs or dict())
 
     with File(fpath, 'a') as file:
         cortex_group = file.create_group('report/cortex')
-        data_dset = cortex_group.create_dataset(
-            'data', dtype=float,
-            data=membrane_potential.data, chunks=True)
+        data_dset = write_blocks(cortex_group, 'data', membrane_potential.data, dtype, buffer_gb=buffer_gb,
+                                 scale=scale, offset=offset, **data_kwargs)
         data_dset.attrs['units'] = 'mV'
 
         mapping_group = cortex_group.create_group('mapping')
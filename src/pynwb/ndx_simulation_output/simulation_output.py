@@ -1,33 +1,164 @@
+import h5py
 import numpy as np
-from pynwb import register_class, docval, get_class
+from pynwb import register_class, register_map, docval, get_class, load_namespaces
+from pynwb.file import LabMetaData
+from pynwb.io.core import NWBContainerMapper
 from hdmf.common.table import VectorIndex, VectorData, DynamicTable, ElementIdentifiers
-from hdmf.utils import call_docval_func
+from hdmf.container import MultiContainerInterface
+from hdmf.utils import call_docval_func, get_docval, popargs
+
+from . import ndx_simulation_output_specpath
 
 namespace = 'ndx-simulation-output'
+load_namespaces(ndx_simulation_output_specpath)
 
 
-def create_ragged_array(name, values):
-    """
-    :param values: list of lists
-    :return:
+def create_ragged_array(name, values, lengths=None, offsets=None, dtype=None,
+                        description='indicates which compartments the data refers to'):
+    """Create a VectorData and its VectorIndex from ragged values
+
+    Parameters
+    ----------
+    name: str
+    values: list of lists, list/iterator of np.ndarray or flat np.ndarray
+        Either one sequence per row, or all rows concatenated if lengths or offsets is specified.
+    lengths: array-like, optional
+        Number of elements in each row of flat values
+    offsets: array-like, optional
+        End of each row in flat values, i.e. the VectorIndex data (np.cumsum(lengths))
+    dtype: type or np.dtype, optional
+        dtype of the data as declared in the spec, e.g. int for number and float for position
+    description: str, optional
+
+    Returns
+    -------
+    VectorData, VectorIndex
+
     """
-    vector_data = VectorData(
-        name, 'indicates which compartments the data refers to',
-        [item for sublist in values for item in sublist])
-    vector_index = VectorIndex(
-        name + '_index', np.cumsum([len(x) for x in values]), target=vector_data)
+    if offsets is not None:
+        data = np.asarray(values, dtype=dtype)
+        index = np.asarray(offsets, dtype=np.uint64)
+    elif lengths is not None:
+        data = np.asarray(values, dtype=dtype)
+        index = np.cumsum(lengths, dtype=np.uint64)
+    else:
+        rows = [np.asarray(row, dtype=dtype) for row in values]
+        index = np.empty(len(rows), dtype=np.uint64)
+        np.cumsum([len(row) for row in rows], out=index)
+        data = np.concatenate(rows) if rows else np.array([], dtype=dtype)
+    if len(index) and index[-1] != len(data):
+        raise ValueError("'{}' has {} elements, but the rows add up to {}".format(name, len(data), index[-1]))
+    vector_data = VectorData(name, description, data)
+    vector_index = VectorIndex(name + '_index', index, target=vector_data)
     return vector_data, vector_index
 
 
+def _concatenate_ranges(starts, stops):
+    """np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)]) without the python loop"""
+    lengths = np.maximum(stops - starts, 0)
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def _contiguous_runs(columns):
+    """Coalesce sorted, unique column indices into runs of adjacent columns
+
+    Returns
+    -------
+    starts, stops: np.array(dtype=int)
+        run i covers columns starts[i]:stops[i]
+    """
+    breaks = np.flatnonzero(np.diff(columns) != 1) + 1
+    return columns[np.r_[0, breaks]], columns[np.r_[breaks - 1, len(columns) - 1]] + 1
+
+
+def _read_columns(data, rows, columns):
+    """Read data[rows, columns] for sorted, unique columns with one hyperslab per run of adjacent columns. From HDF5,
+    the union of the hyperslabs is read with a single call instead of h5py's slow fancy indexing."""
+    out = np.empty((rows.stop - rows.start, len(columns)), dtype=data.dtype)
+    if not out.size:
+        return out
+    starts, stops = _contiguous_runs(columns)
+    if isinstance(data, h5py.Dataset):
+        file_space = data.id.get_space()
+        file_space.select_none()
+        for start, stop in zip(starts, stops):
+            file_space.select_hyperslab((rows.start, start), (out.shape[0], stop - start), op=h5py.h5s.SELECT_OR)
+        # the selection is read in file order, i.e. row by row and with ascending columns
+        data.id.read(h5py.h5s.create_simple(out.shape), file_space, out)
+    else:
+        out_start = 0
+        for start, stop in zip(starts, stops):
+            out[:, out_start:out_start + stop - start] = data[rows, start:stop]
+            out_start += stop - start
+    return out
+
+
+class _CompartmentLookup(object):
+    """Sorted (cell, compartment) keys of all columns of a CompartmentSeries, for vectorized lookups"""
+
+    def __init__(self, csr):
+        self.offsets = csr['offsets']
+        cell_of_column = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        self.numbers = self._build(cell_of_column, csr['number'])
+        if 'label_code' in csr:
+            # queries search the names in sorted order, so map the stored codes to the ranks of their names
+            order = np.argsort(csr['label_names'])
+            ranks = np.empty(len(order), dtype=int)
+            ranks[order] = np.arange(len(order))
+            self.label_names = csr['label_names'][order]
+            self.labels = self._build(cell_of_column, ranks[csr['label_code']])
+        elif 'label' in csr:
+            self.label_names, label_codes = np.unique(csr['label'], return_inverse=True)
+            self.labels = self._build(cell_of_column, label_codes.ravel())
+        else:
+            self.label_names, self.labels = np.array([], dtype=str), None
+
+    @staticmethod
+    def _build(cells, values):
+        low = values.min() if len(values) else 0
+        span = (values.max() - low + 1) if len(values) else 1
+        keys = cells * span + (values - low)
+        columns = np.argsort(keys, kind='stable')
+        return keys[columns], columns, low, span
+
+    @staticmethod
+    def _find(table, cells, values, pairs):
+        keys, columns, low, span = table
+        found = (values >= low) & (values < low + span)
+        query = cells[found] * span + (values[found] - low)
+        starts, stops = np.searchsorted(keys, query, 'left'), np.searchsorted(keys, query, 'right')
+        return columns[_concatenate_ranges(starts, stops)], np.repeat(pairs[found], stops - starts)
+
+    def find(self, cells, numbers=None, labels=None):
+        """Columns of the (cell, number) or (cell, label) pairs, and the index of the pair behind each column"""
+        if numbers is not None:
+            cells, numbers = np.broadcast_arrays(cells, np.asarray(numbers, dtype=int))
+            return self._find(self.numbers, cells.ravel(), numbers.ravel(), np.arange(cells.size))
+        if labels is not None:
+            if self.labels is None or not len(self.label_names):
+                return np.array([], dtype=int), np.array([], dtype=int)
+            cells, labels = np.broadcast_arrays(cells, np.asarray(labels, dtype=str))
+            cells, labels = cells.ravel(), labels.ravel()
+            codes = np.minimum(np.searchsorted(self.label_names, labels), len(self.label_names) - 1)
+            known = self.label_names[codes] == labels
+            return self._find(self.labels, cells[known], codes[known], np.flatnonzero(known))
+        cells = cells.ravel()
+        starts, stops = self.offsets[cells], self.offsets[cells + 1]
+        return _concatenate_ranges(starts, stops), np.repeat(np.arange(len(cells)), stops - starts)
+
+
 @register_class('Compartments', namespace)
 class Compartments(DynamicTable):
+    __fields__ = ('label_names',)
     __columns__ = (
         {'name': 'number', 'index': True,
          'description': 'cell compartment ids corresponding to a each column in the data'},
         {'name': 'position', 'index': True,
          'description': 'the observation intervals for each unit'},
-        {'name': 'label', 'description': 'the electrodes that each spike unit came from',
-         'index': True, 'table': True}
+        {'name': 'label', 'description': 'labels for compartments', 'index': True},
+        {'name': 'label_code', 'description': 'labels for compartments, as codes that index into label_names',
+         'index': True}
     )
 
     @docval({'name': 'name', 'type': str, 'doc': 'Name of this Compartments object',
@@ -39,9 +170,126 @@ class Compartments(DynamicTable):
              'default': None},
             {'name': 'description', 'type': str, 'doc': 'a description of what is in this table',
              'default': "Table that holds information about what places are being recorded."},
+            {'name': 'label_names', 'type': 'array_data',
+             'doc': 'names of the labels in the label_code column. If specified, the labels passed to add_row are '
+                    'stored as integer codes in label_code instead of as text in label', 'default': None},
             )
     def __init__(self, **kwargs):
+        label_names = popargs('label_names', kwargs)
         call_docval_func(super(Compartments, self).__init__, kwargs)
+        if isinstance(label_names, (list, tuple, np.ndarray)):
+            label_names = list(label_names)
+        self.label_names = label_names
+        self._csr_cache = None
+        self._lookup_cache = None
+
+    @docval(*get_docval(DynamicTable.add_row), allow_extra=True)
+    def add_row(self, **kwargs):
+        self.clear_cache()
+        if self.label_names is not None and kwargs.get('label') is not None:
+            kwargs['label_code'] = [self.__get_label_code(label) for label in kwargs.pop('label')]
+        super(Compartments, self).add_row(**kwargs)
+
+    def __get_label_code(self, label):
+        if label not in self.label_names:
+            self.label_names.append(label)
+        return self.label_names.index(label)
+
+    @docval(*get_docval(DynamicTable.add_column), allow_extra=True)
+    def add_column(self, **kwargs):
+        self.clear_cache()
+        super(Compartments, self).add_column(**kwargs)
+
+    def clear_cache(self):
+        """Drop the in-memory copies of the columns made by get_csr, e.g. after the data was modified directly"""
+        self._csr_cache = None
+        self._lookup_cache = None
+
+    def get_csr(self):
+        """Read-only in-memory copies of the columns in compressed sparse row layout, read once and cached until rows
+        or columns are added or clear_cache is called.
+
+        Returns
+        -------
+
+        dict
+            'offsets': the compartments of cell i are columns offsets[i]:offsets[i+1] of the data,
+            'number' and, if present, 'position' and 'label': the values of all compartments, concatenated.
+            Labels stored as codes give 'label_code' and 'label_names' instead of 'label', without decoding them.
+
+        """
+        if getattr(self, '_csr_cache', None) is None:
+            csr = {'offsets': np.r_[0, self['number_index'].data[:]].astype(int),
+                   'number': np.array(self['number'].target.data[:], dtype=int)}
+            if 'position' in self.colnames:
+                csr['position'] = np.array(self['position'].target.data[:], dtype=float)
+            if 'label_code' in self.colnames:
+                csr['label_code'] = np.array(self['label_code'].target.data[:], dtype=int)
+                csr['label_names'] = np.array(self.label_names[:], dtype=str)
+            elif 'label' in self.colnames:
+                csr['label'] = np.array(self['label'].target.data[:], dtype=str)
+            for values in csr.values():
+                values.setflags(write=False)
+            self._csr_cache = csr
+        return self._csr_cache
+
+    def _get_lookup(self):
+        """Sorted (cell, compartment) keys for vectorized lookups, built on first use and cached like get_csr"""
+        if getattr(self, '_lookup_cache', None) is None:
+            self._lookup_cache = _CompartmentLookup(self.get_csr())
+        return self._lookup_cache
+
+    @classmethod
+    def from_csr(cls, number, index_pointer, position=None, label=None, id=None, name='compartments',
+                 description=None):
+        """Build the table straight from flat arrays in compressed sparse row layout, as stored in the mapping of a
+        SONATA report, instead of adding one row per cell.
+
+        Parameters
+        ----------
+        number: array-like(dtype=int)
+            compartment numbers of all cells, concatenated (SONATA element_ids)
+        index_pointer: array-like(dtype=int)
+            the compartments of cell i are number[index_pointer[i]:index_pointer[i+1]] (SONATA index_pointer)
+        position: array-like(dtype=float) (optional)
+            positions of all compartments, concatenated (SONATA element_pos)
+        label: array-like(dtype=str) (optional)
+            labels of all compartments, concatenated. They are stored as integer codes in label_code.
+        id: array-like(dtype=int) (optional)
+            id of each cell (SONATA node_ids). Defaults to 0, 1, 2...
+        name: str (optional)
+        description: str (optional)
+
+        Returns
+        -------
+        Compartments
+
+        """
+        index_pointer = np.asarray(index_pointer, dtype=int)
+        first, last = index_pointer[0], index_pointer[-1]
+        offsets = index_pointer[1:] - first
+
+        descriptions = {col['name']: col['description'] for col in cls.__columns__}
+        columns = []
+        for col_name, values, dtype in (('number', number, int), ('position', position, float)):
+            if values is None:
+                continue
+            columns += create_ragged_array(col_name, values[first:last], offsets=offsets, dtype=dtype,
+                                           description=descriptions[col_name])
+
+        label_names = None
+        if label is not None:
+            label_names, label_code = np.unique(np.asarray(label[first:last], dtype=str), return_inverse=True)
+            columns += create_ragged_array('label_code', label_code.ravel(), offsets=offsets,
+                                           description=descriptions['label_code'])
+            label_names = list(label_names)
+
+        if id is None:
+            id = np.arange(len(offsets))
+        kwargs = dict(name=name, id=np.asarray(id, dtype=int), columns=columns, label_names=label_names)
+        if description is not None:
+            kwargs['description'] = description
+        return cls(**kwargs)
 
 
 @staticmethod
@@ -50,7 +298,16 @@ def _compartment_finder(cell_compartments, cond, dtype, start_ind):
     if isinstance(cond, dtype):
         return start_ind + np.where(cell_compartments == cond)[0]
     else:
-        return np.array([start_ind + np.where(cell_compartments == x)[0] for x in cond]).ravel()
+        return np.concatenate([np.array([], dtype=int)] +
+                              [start_ind + np.where(cell_compartments == x)[0] for x in cond])
+
+
+def _encode_labels(label_names, labels):
+    """Codes (indices into label_names) of a label or of several labels, -1 for labels that aren't in label_names"""
+    label_codes = {name: code for code, name in enumerate(label_names)}
+    if isinstance(labels, str):
+        return label_codes.get(labels, -1)
+    return [label_codes.get(label, -1) for label in labels]
 
 
 def find_compartments(self, cell, compartment_numbers=None, compartment_labels=None):
@@ -73,21 +330,242 @@ def find_compartments(self, cell, compartment_numbers=None, compartment_labels=N
     """
     if compartment_numbers is not None and compartment_labels is not None:
         raise ValueError('you cannot specify both compartments and compartment_labels')
-    if cell == 0:
-        start_ind = 0
-    else:
-        start_ind = self.compartments['number_index'].data[cell-1]
-    cell_compartments = self.compartments['number'][cell]
+    csr = self.compartments.get_csr()
+    start_ind, stop_ind = csr['offsets'][cell], csr['offsets'][cell + 1]
+    cell_compartments = csr['number'][start_ind:stop_ind]
     if compartment_numbers is not None:
         return self._compartment_finder(cell_compartments, compartment_numbers, int, start_ind)
     elif compartment_labels is not None:
-        return self._compartment_finder(cell_compartments, compartment_labels, str, start_ind)
+        if 'label_code' in csr:
+            # compare the stored codes with the codes of the requested labels
+            codes = _encode_labels(csr['label_names'], compartment_labels)
+            return self._compartment_finder(csr['label_code'][start_ind:stop_ind], codes, int, start_ind)
+        cell_labels = csr['label'][start_ind:stop_ind] if 'label' in csr else np.array([], dtype=str)
+        return self._compartment_finder(cell_labels, compartment_labels, str, start_ind)
     else:
         return np.arange(start_ind, start_ind + len(cell_compartments), dtype=int)
 
 
+def find_compartments_batch(self, cells, compartment_numbers=None, compartment_labels=None, return_pairs=False):
+    """Vectorized find_compartments for many cells at once, e.g. the soma of every cell. The lookup structure is built
+    on first use and cached on the Compartments table.
+
+    Parameters
+    ----------
+    cells: int | Iterable(int)
+        find indices of compartments of these cells
+    compartment_numbers: int | Iterable(int) (optional)
+        compartment number(s), either one for all cells or one per cell
+    compartment_labels: str | Iterable(str) (optional)
+        or compartment label(s), either one for all cells or one per cell
+    return_pairs: bool (optional)
+        also return the index of the (cell, compartment) pair behind each column
+
+    Returns
+    -------
+
+    np.array(dtype=int)
+        The indices of the matching columns, in the order of the requested cells. A (cell, compartment) pair can match
+        no column or several (e.g. several positions in one compartment), so the columns only line up with the
+        requested pairs through the pair indices.
+    np.array(dtype=int)
+        If return_pairs, the index of the requested pair (of cells broadcast against compartment_numbers or
+        compartment_labels) of each column, e.g. to tell which cells lack a compartment.
+
+    """
+    if compartment_numbers is not None and compartment_labels is not None:
+        raise ValueError('you cannot specify both compartments and compartment_labels')
+    columns, pairs = self.compartments._get_lookup().find(np.asarray(cells, dtype=int), compartment_numbers,
+                                                          compartment_labels)
+    return (columns, pairs) if return_pairs else columns
+
+
+def _select_columns(series, cells=None, compartments=None, labels=None):
+    """Columns of the compartments of cells with numbers in compartments, or with labels in labels, which are applied
+    to every cell like in find_compartments. Columns are in the order of cells, and ascending within a cell."""
+    if compartments is not None and labels is not None:
+        raise ValueError('you cannot specify both compartments and labels')
+    if cells is None and compartments is None and labels is None:
+        return np.arange(series.data.shape[1])
+    csr = series.compartments.get_csr()
+    offsets = csr['offsets']
+    if cells is None:
+        columns = np.arange(offsets[-1])
+    else:
+        cells = np.atleast_1d(np.asarray(cells, dtype=int))
+        columns = _concatenate_ranges(offsets[cells], offsets[cells + 1])
+
+    if compartments is not None:
+        return columns[np.isin(csr['number'][columns], compartments)]
+    if labels is None:
+        return columns
+    if 'label_code' in csr:
+        return columns[np.isin(csr['label_code'][columns], _encode_labels(csr['label_names'], labels))]
+    if 'label' in csr:
+        return columns[np.isin(csr['label'][columns], labels)]
+    return columns[:0]
+
+
+def _select_rows(series, time_range=None):
+    """Rows of a TimeSeries at start <= t < stop of time_range, and the times of those rows"""
+    if series.timestamps is not None:
+        timestamps = series.timestamps
+        rows = slice(0, len(timestamps))
+        if time_range is not None:
+            start, stop = np.searchsorted(timestamps, time_range)
+            rows = slice(start, max(start, stop))
+        return rows, np.asarray(timestamps[rows])
+
+    rows = slice(0, series.data.shape[0])
+    if time_range is not None:
+        start, stop = np.ceil((np.asarray(time_range) - series.starting_time) * series.rate - 1e-9).astype(int)
+        rows = slice(min(max(start, 0), rows.stop), min(max(stop, 0), rows.stop))
+    rows = slice(rows.start, max(rows.start, rows.stop))
+    return rows, series.starting_time + np.arange(rows.start, rows.stop) / series.rate
+
+
+def _read_selection(datasets, rows, columns):
+    read_columns, order = np.unique(columns, return_inverse=True)
+    return [_read_columns(data, rows, read_columns)[:, order.ravel()] for data in datasets]
+
+
+def _in_unit(series, data):
+    """Apply the conversion and offset of series to data read from it, e.g. quantized int16 data"""
+    conversion, offset = series.conversion, series.offset
+    if conversion == 1. and offset == 0.:
+        return data
+    return data * conversion + offset
+
+
+def get_data(self, cells=None, compartments=None, labels=None, time_range=None):
+    """Read the data of some compartments of some cells within a window of time, e.g. the soma of cells 10-20 from 1.0
+    to 1.5 s, with as few reads as possible.
+
+    Parameters
+    ----------
+    cells: int | Iterable(int) (optional)
+        cells (rows of the Compartments table) to read. Defaults to all cells.
+    compartments: int | Iterable(int) (optional)
+        compartment number(s) to read of every cell. Defaults to all compartments.
+    labels: str | Iterable(str) (optional)
+        or compartment label(s) to read of every cell
+    time_range: (float, float) (optional)
+        start and stop time in seconds. Samples at start <= t < stop are read. Defaults to all samples.
+
+    Returns
+    -------
+
+    data: np.array
+        (time x columns) array with the selected samples of the selected columns, in the unit of the series (i.e. with
+        conversion and offset applied)
+    timestamps: np.array(dtype=float)
+        time in seconds of each row of data
+    columns: np.array(dtype=int)
+        index in the data of the CompartmentSeries of each column of data
+
+    """
+    columns = _select_columns(self, cells, compartments, labels)
+    rows, timestamps = _select_rows(self, time_range)
+    data, = _read_selection([self.data], rows, columns)
+    return _in_unit(self, data), timestamps, columns
+
+
+def get_downsampled(self):
+    """The DownsampledCompartmentSeries of this series in the same NWBFile, from the finest to the coarsest
+
+    Returns
+    -------
+
+    list(DownsampledCompartmentSeries)
+
+    """
+    root = self
+    while root.parent is not None:
+        root = root.parent
+    levels = [obj for obj in root.all_children()
+              if isinstance(obj, DownsampledCompartmentSeries) and obj.source is self]
+    return sorted(levels, key=lambda level: level.decimation)
+
+
+def get_envelope(self, n_pixels, cells=None, compartments=None, labels=None, time_range=None):
+    """Read the mean, min and max of the data at the coarsest rate that still has n_pixels samples in time_range, from
+    the DownsampledCompartmentSeries of this series. Falls back to the full-rate data if no level is fine enough.
+
+    Parameters
+    ----------
+    n_pixels: int
+        number of samples (e.g. horizontal pixels of a plot) needed within time_range
+    cells, compartments, labels, time_range:
+        select the data like in get_data
+
+    Returns
+    -------
+
+    mean, min, max: np.array
+        (time x columns) envelope of the selected columns, in the unit of the series
+    timestamps: np.array(dtype=float)
+        start time in seconds of each window
+    columns: np.array(dtype=int)
+        index in the data of the CompartmentSeries of each column
+
+    """
+    columns = _select_columns(self, cells, compartments, labels)
+    for level in reversed(self.get_downsampled()):
+        rows, timestamps = _select_rows(level, time_range)
+        if rows.stop - rows.start >= n_pixels:
+            data_mean, data_min, data_max = [_in_unit(level, data) for data in _read_selection(
+                [level.data, level.min, level.max], rows, columns)]
+            return data_mean, data_min, data_max, timestamps, columns
+
+    rows, timestamps = _select_rows(self, time_range)
+    data, = _read_selection([self.data], rows, columns)
+    data = _in_unit(self, data)
+    return data, data, data, timestamps, columns
+
+
 CompartmentSeries = get_class('CompartmentSeries', namespace)
 CompartmentSeries._compartment_finder = _compartment_finder
 CompartmentSeries.find_compartments = find_compartments
+CompartmentSeries.find_compartments_batch = find_compartments_batch
+CompartmentSeries.get_data = get_data
+CompartmentSeries.get_downsampled = get_downsampled
+CompartmentSeries.get_envelope = get_envelope
+
+DownsampledCompartmentSeries = get_class('DownsampledCompartmentSeries', namespace)
+
+
+@register_class('SimulationMetaData', namespace)
+class SimulationMetaData(MultiContainerInterface, LabMetaData):
+    """Metadata of a simulation, with a Compartments table per node population"""
+
+    __clsconf__ = {
+        'attr': 'compartments_tables',
+        'type': Compartments,
+        'add': 'add_compartments',
+        'get': 'get_compartments',
+    }
+
+    @docval({'name': 'compartments', 'type': (Compartments, list, tuple, dict),
+             'doc': 'Compartments table, or tables of several node populations (with different names)'},
+            {'name': 'name', 'type': str, 'doc': 'name of this SimulationMetaData', 'default': 'simulation'})
+    def __init__(self, **kwargs):
+        compartments, name = popargs('compartments', 'name', kwargs)
+        super(SimulationMetaData, self).__init__(name=name)
+        self.compartments_tables = [compartments] if isinstance(compartments, Compartments) else compartments
+
+    @property
+    def compartments(self):
+        """The Compartments table if there is a single one (as in files with one node population), otherwise the
+        tables by name, as compartments_tables"""
+        if len(self.compartments_tables) == 1:
+            return next(iter(self.compartments_tables.values()))
+        return self.compartments_tables
+
+
+@register_map(SimulationMetaData)
+class SimulationMetaDataMap(NWBContainerMapper):
 
-SimulationMetaData = get_class('SimulationMetaData', namespace)
+    def __init__(self, spec):
+        super(SimulationMetaDataMap, self).__init__(spec)
+        # the tables are read into compartments_tables, and passed to the constructor as compartments
+        self.map_attr('compartments_tables', self.spec.get_data_type('Compartments'))
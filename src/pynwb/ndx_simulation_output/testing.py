@@ -0,0 +1,88 @@
+"""Synthetic SONATA output for the tests and the benchmarks. Report data are written in blocks of time steps, so that
+the size of the files is not limited by memory."""
+import h5py
+import numpy as np
+
+
+def write_report(fpath, n_cells=5, n_compartments=3, n_times=100, population='cortex', dt=0.1, dtype='float64',
+                 offset=0., vary_compartments=False, chunked=False, block_size=10000, seed=0, mode='w'):
+    """Write a compartment report (/report/<population>)
+
+    Parameters
+    ----------
+    fpath: str
+    n_cells: int
+    n_compartments: int
+        compartments per cell, or their average if vary_compartments
+    n_times: int
+    population: str
+    dt: float
+        time step (ms)
+    dtype: str
+    offset: float
+        added to the standard normal data, e.g. a resting potential
+    vary_compartments: bool
+        draw the number of compartments of each cell between 1 and 2 * n_compartments - 1
+    chunked: bool
+        write the data chunked by up to 1000 x 1000
+    block_size: int
+        time steps written at once
+    seed: int
+    mode: str
+        h5py.File mode, 'a' to add a population to an existing file
+    """
+    rng = np.random.default_rng(seed)
+    if vary_compartments:
+        counts = rng.integers(1, 2 * n_compartments, n_cells)
+    else:
+        counts = np.full(n_cells, n_compartments)
+    index_pointer = np.concatenate(([0], np.cumsum(counts)))
+    n_columns = int(index_pointer[-1])
+    element_ids = np.arange(n_columns) - np.repeat(index_pointer[:-1], counts)
+    chunks = (min(n_times, 1000), min(n_columns, 1000)) if chunked else None
+
+    with h5py.File(fpath, mode) as h5:
+        grp = h5.create_group('report/{}'.format(population))
+        data = grp.create_dataset('data', shape=(n_times, n_columns), dtype=dtype, chunks=chunks)
+        data.attrs['units'] = 'mV'
+        for start in range(0, n_times, block_size):
+            stop = min(start + block_size, n_times)
+            data[start:stop] = offset + rng.standard_normal((stop - start, n_columns), dtype=dtype)
+        mapping = grp.create_group('mapping')
+        mapping.create_dataset('element_ids', data=element_ids)
+        mapping.create_dataset('element_pos', data=element_ids / np.maximum(np.repeat(counts, counts) - 1, 1))
+        mapping.create_dataset('index_pointer', data=index_pointer)
+        mapping.create_dataset('node_ids', data=np.arange(n_cells))
+        time = mapping.create_dataset('time', data=[0., n_times * dt, dt])
+        time.attrs['units'] = 'ms'
+
+
+def write_spikes(fpath, n_cells=5, n_spikes=50, duration=10., population='cortex', sorting='by_time', seed=1,
+                 mode='w'):
+    """Write spikes (/spikes/<population>) of n_cells firing uniformly within duration (ms)"""
+    rng = np.random.default_rng(seed)
+    node_ids = rng.integers(0, n_cells, n_spikes)
+    timestamps = np.sort(rng.uniform(0, duration, n_spikes))
+    if sorting == 'by_id':
+        order = np.argsort(node_ids, kind='stable')
+        node_ids, timestamps = node_ids[order], timestamps[order]
+    with h5py.File(fpath, mode) as h5:
+        grp = h5.create_group('spikes/{}'.format(population))
+        grp.attrs['sorting'] = sorting
+        grp.create_dataset('node_ids', data=node_ids)
+        grp.create_dataset('timestamps', data=timestamps).attrs['units'] = 'ms'
+
+
+def write_ecp(fpath, electrodes_fpath, n_channels=4, n_times=100, dt=0.1, seed=2):
+    """Write an extracellular potential (/ecp) and the matching electrode positions file"""
+    rng = np.random.default_rng(seed)
+    with h5py.File(fpath, 'w') as h5:
+        grp = h5.create_group('ecp')
+        grp.create_dataset('channel_id', data=np.arange(n_channels))
+        data = grp.create_dataset('data', data=rng.standard_normal((n_times, n_channels)).astype('float32'))
+        data.attrs['units'] = 'mV'
+        grp.create_dataset('time', data=[0., n_times * dt, dt]).attrs['units'] = 'ms'
+    with open(electrodes_fpath, 'w') as f:
+        f.write('channel x_pos y_pos z_pos\n')
+        for channel in range(n_channels):
+            f.write('{} 0.0 {} 0.0\n'.format(channel, channel * 10.))
@@ -0,0 +1,463 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from importlib.util import find_spec
+
+import h5py
+import numpy as np
+from pynwb import NWBHDF5IO
+from ndx_simulation_output.io.from_sonata import sonata2nwb, SonataDataChunkIterator
+from ndx_simulation_output.io.to_sonata import export_membrane_potential, nwb2sonata
+from ndx_simulation_output.testing import write_ecp, write_report, write_spikes
+
+
+class SonataConversionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'sonata')
+        os.mkdir(self.data_dir)
+        self.report_fpath = os.path.join(self.data_dir, 'membrane_potential.h5')
+        self.spikes_fpath = os.path.join(self.data_dir, 'spikes.h5')
+        write_report(self.report_fpath)
+        write_spikes(self.spikes_fpath)
+        self.nwb_fpath = os.path.join(self.tmp_dir, 'converted.nwb')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_streamed_report(self):
+        sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=1e-6)
+
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected = h5['report/cortex/data'][:]
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            nwbfile = io.read()
+            np.testing.assert_array_equal(nwbfile.acquisition['membrane_potential'].data[:], expected)
+
+    def test_iterator_buffers_whole_rows(self):
+        with h5py.File(self.report_fpath, 'r') as h5:
+            iterator = SonataDataChunkIterator(h5['report/cortex/data'], buffer_gb=2e-6, chunk_shape=(10, 5))
+            self.assertEqual(iterator.buffer_shape, (10, 15))
+            self.assertEqual(iterator.num_buffers, 10)
+
+    def test_iterator_buffer_fits_wide_report(self):
+        # a band of tall, narrow chunks across all columns doesn't fit into the buffer
+        wide_fpath = os.path.join(self.tmp_dir, 'wide.h5')
+        write_report(wide_fpath, n_cells=2000)
+        buffer_gb = 1e-4
+        with h5py.File(wide_fpath, 'r') as h5:
+            dataset = h5['report/cortex/data']
+            iterator = SonataDataChunkIterator(dataset, buffer_gb=buffer_gb, chunk_shape=(100, 3))
+            self.assertLessEqual(np.prod(iterator.buffer_shape) * dataset.dtype.itemsize, buffer_gb * 1e9)
+            self.assertEqual(iterator.buffer_shape[1] % 3, 0)
+            data = np.empty(dataset.shape)
+            for chunk in iterator:
+                data[chunk.selection] = chunk.data
+            np.testing.assert_array_equal(data, dataset[:])
+
+    def test_data_io_kwargs(self):
+        sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=1e-6,
+                   data_io_kwargs={'membrane_potential': {'compression': 'gzip', 'shuffle': True}})
+
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            data = io.read().acquisition['membrane_potential'].data
+            self.assertEqual(data.compression, 'gzip')
+            self.assertTrue(data.shuffle)
+            # by default a chunk holds all compartments of a cell
+            self.assertEqual(data.chunks, (100, 3))
+
+    def test_spikes(self):
+        for sorting in ('by_time', 'by_id'):
+            write_spikes(self.spikes_fpath, sorting=sorting)
+            sonata2nwb(self.spikes_fpath, self.nwb_fpath)
+
+            with h5py.File(self.spikes_fpath, 'r') as h5:
+                node_ids = h5['spikes/cortex/node_ids'][:]
+                timestamps = h5['spikes/cortex/timestamps'][:]
+            with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+                units = io.read().units
+                self.assertEqual(list(units.id.data[:]), list(np.unique(node_ids)))
+                for i, unit_id in enumerate(units.id.data[:]):
+                    np.testing.assert_array_equal(units['spike_times'][i], timestamps[node_ids == unit_id])
+
+    def test_spikes_files(self):
+        # the units of a second spikes file are added after those of the first one
+        write_spikes(os.path.join(self.data_dir, 'more_spikes.h5'), n_cells=2, n_spikes=20)
+        sonata2nwb(self.data_dir, self.nwb_fpath)
+
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            units = io.read().units
+            self.assertEqual(len(units['spike_times'].target.data), 70)
+            self.assertEqual(len(units), 7)
+            stops = units['spike_times'].data[:]
+            self.assertEqual(stops[-1], 70)
+            self.assertTrue(np.all(np.diff(stops) > 0))
+
+    def test_parallel_read(self):
+        write_report(os.path.join(self.data_dir, 'calcium_concentration.h5'))
+        write_ecp(os.path.join(self.data_dir, 'ecp.h5'), os.path.join(self.data_dir, 'electrodes.csv'))
+        sonata2nwb(self.data_dir, self.nwb_fpath, n_jobs=2)
+
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            nwbfile = io.read()
+            self.assertEqual(set(nwbfile.acquisition),
+                             {'membrane_potential', 'calcium_concentration', 'ElectricalSeries'})
+            # reports with the same mapping share the Compartments table
+            self.assertIs(nwbfile.acquisition['membrane_potential'].compartments,
+                          nwbfile.acquisition['calcium_concentration'].compartments)
+            self.assertEqual(len(nwbfile.units), 5)
+
+    def test_downsample(self):
+        sonata2nwb(self.data_dir, self.nwb_fpath, downsample=(10, 50), buffer_gb=1e-6)
+
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected = h5['report/cortex/data'][:]
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            cs = io.read().acquisition['membrane_potential']
+            self.assertEqual([level.decimation for level in cs.get_downsampled()], [10, 50])
+
+            data_mean, data_min, data_max, timestamps, columns = cs.get_envelope(5, cells=[1])
+            self.assertEqual(data_mean.shape, (10, 3))
+            np.testing.assert_allclose(data_mean, expected.reshape(10, 10, 15).mean(axis=1)[:, columns])
+            np.testing.assert_array_equal(data_min, expected.reshape(10, 10, 15).min(axis=1)[:, columns])
+            np.testing.assert_array_equal(data_max, expected.reshape(10, 10, 15).max(axis=1)[:, columns])
+
+            data_mean, _, _, _, _ = cs.get_envelope(2)
+            self.assertEqual(data_mean.shape, (2, 15))
+
+        # series without compartments or time steps get empty levels
+        for filters, shape in ((dict(node_ids=[999]), (10, 0)), (dict(time_range=(100., 100.)), (0, 15))):
+            sonata2nwb(self.data_dir, self.nwb_fpath, downsample=(10,), **filters)
+            with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+                level, = io.read().acquisition['membrane_potential'].get_downsampled()
+                self.assertEqual(level.data.shape, shape)
+
+    def test_summary(self):
+        for buffer_gb in (None, 1e-6):
+            sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=buffer_gb, summary=True, summary_threshold=0.5)
+
+            with h5py.File(self.report_fpath, 'r') as h5:
+                expected = h5['report/cortex/data'][:]
+            with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+                summary = io.read().processing['summary']['membrane_potential_summary']
+                np.testing.assert_allclose(summary['mean'].data[:], expected.mean(axis=0))
+                np.testing.assert_allclose(summary['std'].data[:], expected.std(axis=0))
+                np.testing.assert_array_equal(summary['min'].data[:], expected.min(axis=0))
+                np.testing.assert_array_equal(summary['max'].data[:], expected.max(axis=0))
+                above = expected >= 0.5
+                np.testing.assert_array_equal(summary['threshold_crossings'].data[:],
+                                              np.count_nonzero(above[1:] & ~above[:-1], axis=0))
+
+    def test_append(self):
+        # simulate a run that writes its output in two steps, converting after each
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected_data = h5['report/cortex/data'][:]
+        with h5py.File(self.spikes_fpath, 'r') as h5:
+            node_ids, timestamps = h5['spikes/cortex/node_ids'][:], h5['spikes/cortex/timestamps'][:]
+
+        def write_until(n_times, n_spikes):
+            with h5py.File(self.report_fpath, 'a') as h5:
+                del h5['report/cortex/data']
+                h5.create_dataset('report/cortex/data', data=expected_data[:n_times])
+            with h5py.File(self.spikes_fpath, 'a') as h5:
+                for name, values in (('node_ids', node_ids), ('timestamps', timestamps)):
+                    del h5['spikes/cortex/' + name]
+                    h5.create_dataset('spikes/cortex/' + name, data=values[:n_spikes])
+
+        write_until(40, 20)
+        sonata2nwb(self.data_dir, self.nwb_fpath, append=True)
+        write_until(100, 50)
+        sonata2nwb(self.data_dir, self.nwb_fpath, append=True, until=9.)  # 90 time steps, spikes before 9 ms
+
+        with open(self.nwb_fpath + '.progress.json') as f:
+            progress = json.load(f)['files']
+        self.assertEqual(progress[os.path.abspath(self.report_fpath)], {'report': 90})
+        n_spikes = np.count_nonzero(timestamps < 9.)
+        self.assertEqual(progress[os.path.abspath(self.spikes_fpath)], {'spikes': n_spikes})
+
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            nwbfile = io.read()
+            np.testing.assert_array_equal(nwbfile.acquisition['membrane_potential'].data[:], expected_data[:90])
+            units = nwbfile.units
+            node_ids, timestamps = node_ids[:n_spikes], timestamps[:n_spikes]
+            self.assertEqual(list(units.id[:]), sorted(set(node_ids)))
+            for i, unit_id in enumerate(units.id[:]):
+                np.testing.assert_array_equal(units['spike_times'][i], timestamps[node_ids == unit_id])
+
+    def test_append_spikes_files(self):
+        # spikes files converted in separate calls are all kept in the units
+        other_fpath = os.path.join(self.data_dir, 'other_spikes.h5')
+        write_spikes(other_fpath, n_cells=2, n_spikes=20, seed=3)
+        expected = {}
+        for fpath in (self.spikes_fpath, other_fpath):
+            with h5py.File(fpath, 'r') as h5:
+                for unit_id, timestamp in zip(h5['spikes/cortex/node_ids'][:], h5['spikes/cortex/timestamps'][:]):
+                    expected.setdefault(unit_id, []).append(timestamp)
+
+        sonata2nwb([self.report_fpath, self.spikes_fpath], self.nwb_fpath, append=True)
+        sonata2nwb([self.report_fpath, other_fpath], self.nwb_fpath, append=True)
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            units = io.read().units
+            self.assertEqual(len(units['spike_times'].target.data), 70)
+            for i, unit_id in enumerate(units.id.data[:]):
+                np.testing.assert_array_equal(units['spike_times'][i], expected[unit_id])
+
+        # an interrupted write of the units is rebuilt from the sonata files
+        with h5py.File(self.nwb_fpath, 'a') as h5:
+            h5['units/spike_times'].resize((10,))
+        sonata2nwb([self.report_fpath, self.spikes_fpath], self.nwb_fpath, append=True)
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            units = io.read().units
+            self.assertEqual(len(units['spike_times'].target.data), 70)
+            for i, unit_id in enumerate(units.id.data[:]):
+                np.testing.assert_array_equal(units['spike_times'][i], expected[unit_id])
+
+    def test_resume(self):
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected_data = h5['report/cortex/data'][:]
+        buffer_gb = 10 * expected_data[0].nbytes / 1e9  # segments of 10 time steps
+
+        # interrupted while writing the time steps 40 to 50
+        sonata2nwb(self.data_dir, self.nwb_fpath, append=True, until=5., buffer_gb=buffer_gb)
+        with h5py.File(self.nwb_fpath, 'a') as h5:
+            h5['acquisition/membrane_potential/data'][45:50] = 0.
+
+        sonata2nwb(self.data_dir, self.nwb_fpath, append=True, buffer_gb=buffer_gb)
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            np.testing.assert_array_equal(io.read().acquisition['membrane_potential'].data[:], expected_data)
+        with open(self.nwb_fpath + '.progress.json') as f:
+            segments = json.load(f)['segments'][os.path.abspath(self.report_fpath)]['report']
+        self.assertEqual([segment[:2] for segment in segments], [[i, i + 10] for i in range(0, 100, 10)])
+
+        with h5py.File(self.report_fpath, 'a') as h5:
+            h5['report/cortex/data'][95] = 0.
+        with self.assertRaises(ValueError):
+            sonata2nwb(self.data_dir, self.nwb_fpath, append=True, buffer_gb=buffer_gb)
+
+    def test_virtual(self):
+        write_ecp(os.path.join(self.data_dir, 'ecp.h5'), os.path.join(self.data_dir, 'electrodes.csv'))
+        sonata2nwb(self.data_dir, self.nwb_fpath, link_mode='virtual')
+
+        with h5py.File(self.nwb_fpath, 'r') as h5:
+            self.assertTrue(h5['acquisition/membrane_potential/data'].is_virtual)
+            self.assertTrue(h5['acquisition/ElectricalSeries/data'].is_virtual)
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected = h5['report/cortex/data'][:]
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            nwbfile = io.read()
+            cs = nwbfile.acquisition['membrane_potential']
+            np.testing.assert_array_equal(cs.data[:], expected)
+            self.assertEqual(cs.unit, 'mV')
+            self.assertEqual(nwbfile.acquisition['ElectricalSeries'].data.shape, (100, 4))
+
+        with self.assertRaises(ValueError):
+            sonata2nwb(self.data_dir, self.nwb_fpath, link_mode='external')
+
+    def test_reduced_precision(self):
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected = h5['report/cortex/data'][:]
+
+        sonata2nwb(self.data_dir, self.nwb_fpath, report_dtype='float32')
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            data = io.read().acquisition['membrane_potential'].data
+            self.assertEqual(data.dtype, np.float32)
+            np.testing.assert_array_equal(data[:], expected.astype(np.float32))
+
+        for buffer_gb in (None, 1e-6):
+            sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=buffer_gb, report_resolution=1e-3, report_offset=-1.)
+            with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+                cs = io.read().acquisition['membrane_potential']
+                self.assertEqual(cs.data.dtype, np.int16)
+                self.assertEqual((cs.conversion, cs.offset, cs.resolution), (1e-3, -1., 1e-3))
+                data, _, _ = cs.get_data()
+                np.testing.assert_allclose(data, expected, atol=5e-4 + 1e-9)
+
+                export_dir = os.path.join(self.tmp_dir, 'exported')
+                os.mkdir(export_dir)
+                export_membrane_potential(cs, export_dir)
+            with h5py.File(os.path.join(export_dir, 'membrane_potential.h5'), 'r') as h5:
+                self.assertEqual(h5['report/cortex/data'].dtype, np.float32)
+                np.testing.assert_allclose(h5['report/cortex/data'][:], expected, atol=5e-4 + 1e-6)
+            shutil.rmtree(export_dir)
+
+    def test_streamed_ecp(self):
+        ecp_fpath = os.path.join(self.data_dir, 'ecp.h5')
+        electrodes_fpath = os.path.join(self.data_dir, 'electrodes.csv')
+        write_ecp(ecp_fpath, electrodes_fpath, n_channels=6)
+        with open(electrodes_fpath, 'r') as f:
+            header, *rows = f.readlines()
+        with open(electrodes_fpath, 'w') as f:
+            f.writelines([header] + rows[::-1])
+        with h5py.File(ecp_fpath, 'r') as h5:
+            expected = h5['ecp/data'][:]
+
+        sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=1e-6,
+                   data_io_kwargs={'ElectricalSeries': {'chunks': (20, 3), 'compression': 'gzip'}})
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            nwbfile = io.read()
+            es = nwbfile.acquisition['ElectricalSeries']
+            np.testing.assert_array_equal(es.data[:], expected)
+            self.assertEqual(es.data.chunks, (20, 3))
+            np.testing.assert_array_equal(nwbfile.electrodes.id.data[:], np.arange(6)[::-1])
+            np.testing.assert_array_equal(nwbfile.electrodes.id.data[:][es.electrodes.data[:]], np.arange(6))
+            np.testing.assert_array_equal(nwbfile.electrodes['y'].data[:], np.arange(6)[::-1] * 10.)
+
+        with open(electrodes_fpath, 'w') as f:
+            f.writelines([header] + rows[:5])
+        with self.assertRaises(ValueError):
+            sonata2nwb(self.data_dir, self.nwb_fpath)
+
+    def test_populations(self):
+        write_report(self.report_fpath, n_cells=2, n_compartments=2, population='lgn', mode='a')
+        write_spikes(self.spikes_fpath, n_cells=2, n_spikes=10, population='lgn', mode='a')
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected = {pop: h5['report/{}/data'.format(pop)][:] for pop in ('cortex', 'lgn')}
+
+        for buffer_gb in (None, 1e-6):
+            sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=buffer_gb)
+            with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+                nwbfile = io.read()
+                for pop, n_cells in (('cortex', 5), ('lgn', 2)):
+                    cs = nwbfile.acquisition['membrane_potential_{}'.format(pop)]
+                    np.testing.assert_array_equal(cs.data[:], expected[pop])
+                    self.assertIs(cs.compartments,
+                                  nwbfile.lab_meta_data['simulation'].get_compartments('compartments_{}'.format(pop)))
+                    self.assertEqual(len(cs.compartments), n_cells)
+                populations = nwbfile.units['population'].data[:]
+                self.assertEqual(list(np.unique(populations)), ['cortex', 'lgn'])
+                self.assertEqual(len(nwbfile.units['spike_times'].target.data), 60)
+
+        sonata2nwb(self.data_dir, self.nwb_fpath, population='lgn')
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            nwbfile = io.read()
+            np.testing.assert_array_equal(nwbfile.acquisition['membrane_potential'].data[:], expected['lgn'])
+            self.assertNotIn('population', nwbfile.units.colnames)
+            # a single table is the compartments of the simulation, as in files of earlier versions
+            self.assertIs(nwbfile.lab_meta_data['simulation'].compartments,
+                          nwbfile.acquisition['membrane_potential'].compartments)
+
+        # node ids by population, where lgn has none selected
+        for buffer_gb in (None, 1e-6):
+            sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=buffer_gb, node_ids={'cortex': [1, 3], 'lgn': []})
+            with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+                nwbfile = io.read()
+                np.testing.assert_array_equal(nwbfile.acquisition['membrane_potential_cortex'].data[:],
+                                              expected['cortex'][:, [3, 4, 5, 9, 10, 11]])
+                self.assertEqual(nwbfile.acquisition['membrane_potential_lgn'].data.shape, (100, 0))
+                self.assertEqual(set(nwbfile.units['population'].data[:]), {'cortex'})
+                self.assertTrue(set(nwbfile.units.id.data[:]) <= {1, 3})
+
+    def test_population_files(self):
+        # the populations in separate files get a Compartments table each, and the units a population column
+        os.remove(self.report_fpath)
+        os.remove(self.spikes_fpath)
+        for pop, n_cells in (('v1', 5), ('lgn', 2)):
+            write_report(os.path.join(self.data_dir, '{}_membrane.h5'.format(pop)), n_cells=n_cells,
+                         n_compartments=n_cells, population=pop)
+            write_spikes(os.path.join(self.data_dir, '{}_spikes.h5'.format(pop)), n_cells=n_cells, population=pop)
+
+        sonata2nwb(self.data_dir, self.nwb_fpath)
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            nwbfile = io.read()
+            simulation = nwbfile.lab_meta_data['simulation']
+            self.assertEqual(set(simulation.compartments_tables), {'compartments_v1', 'compartments_lgn'})
+            for pop, n_cells in (('v1', 5), ('lgn', 2)):
+                cs = nwbfile.acquisition['{}_membrane'.format(pop)]
+                self.assertIs(cs.compartments, simulation.get_compartments('compartments_{}'.format(pop)))
+                self.assertEqual(len(cs.compartments), n_cells)
+            populations = nwbfile.units['population'].data[:]
+            self.assertEqual(len(populations), len(nwbfile.units))
+            self.assertEqual(set(populations), {'v1', 'lgn'})
+            self.assertEqual(len(nwbfile.units['spike_times'].target.data), 100)
+
+    def test_rank_reports(self):
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected = h5['report/cortex/data'][:]
+        rank_fpaths = [os.path.join(self.tmp_dir, 'rank_{}.h5'.format(rank)) for rank in range(2)]
+        # rank 0 simulated cells 0-2, rank 1 cells 3-4
+        for rank_fpath, cells in zip(rank_fpaths, (range(3), range(3, 5))):
+            write_report(rank_fpath, n_cells=len(cells))
+            with h5py.File(rank_fpath, 'a') as h5:
+                h5['report/cortex/data'][:] = expected[:, cells.start * 3:cells.stop * 3]
+                h5['report/cortex/mapping/node_ids'][:] = np.array(cells)
+                h5['report/cortex/mapping/time'][:] = [5., 15., .1]
+
+        sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=1e-6, n_jobs=2,
+                   rank_reports={'merged_potential': rank_fpaths})
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            cs = io.read().acquisition['merged_potential']
+            np.testing.assert_array_equal(cs.data[:], expected)
+            self.assertEqual(cs.unit, 'mV')
+            self.assertAlmostEqual(cs.starting_time, 0.005)
+            np.testing.assert_array_equal(cs.compartments['number'].target.data[:], np.tile(np.arange(3), 5))
+            data, _, columns = cs.get_data(cells=[1, 3])
+            np.testing.assert_array_equal(data, expected[:, [3, 4, 5, 9, 10, 11]])
+
+        with self.assertRaises(ValueError):
+            sonata2nwb(self.data_dir, self.nwb_fpath, rank_reports={'merged_potential': rank_fpaths},
+                       data_io_kwargs={'merged_potential': dict(compression='gzip')})
+        write_report(rank_fpaths[1], n_cells=2, n_times=50)
+        with self.assertRaises(ValueError):
+            sonata2nwb(self.data_dir, self.nwb_fpath, rank_reports={'merged_potential': rank_fpaths})
+
+    def test_filters(self):
+        write_ecp(os.path.join(self.data_dir, 'ecp.h5'), os.path.join(self.data_dir, 'electrodes.csv'))
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected = h5['report/cortex/data'][20:50, [3, 5, 9, 11]]
+        with h5py.File(self.spikes_fpath, 'r') as h5:
+            node_ids, timestamps = h5['spikes/cortex/node_ids'][:], h5['spikes/cortex/timestamps'][:]
+        selected = np.isin(node_ids, [1, 3]) & (timestamps >= 2.) & (timestamps < 5.)
+
+        for buffer_gb in (None, 1e-6):
+            sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=buffer_gb, node_ids=[1, 3], compartments=[0, 2],
+                       time_range=(2., 5.))
+            with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+                nwbfile = io.read()
+                cs = nwbfile.acquisition['membrane_potential']
+                np.testing.assert_array_equal(cs.data[:], expected)
+                self.assertAlmostEqual(cs.starting_time, 0.002)
+                np.testing.assert_array_equal(cs.compartments.id.data[:], [1, 3])
+                np.testing.assert_array_equal(cs.compartments['number'].target.data[:], [0, 2, 0, 2])
+                np.testing.assert_array_equal(np.sort(nwbfile.units['spike_times'].target.data[:]),
+                                              np.sort(timestamps[selected]))
+                self.assertEqual(set(nwbfile.units.id.data[:]), set(node_ids[selected]))
+                self.assertEqual(nwbfile.acquisition['ElectricalSeries'].data.shape, (30, 4))
+
+            # selections without compartments or time steps are written empty
+            for filters, shape, ecp_shape in ((dict(node_ids=[999]), (100, 0), (100, 4)),
+                                              (dict(time_range=(100., 100.)), (0, 15), (0, 4))):
+                sonata2nwb(self.data_dir, self.nwb_fpath, buffer_gb=buffer_gb, **filters)
+                with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+                    nwbfile = io.read()
+                    self.assertEqual(nwbfile.acquisition['membrane_potential'].data.shape, shape)
+                    self.assertEqual(nwbfile.acquisition['ElectricalSeries'].data.shape, ecp_shape)
+
+        with self.assertRaises(ValueError):
+            sonata2nwb(self.data_dir, self.nwb_fpath, append=True, node_ids=[1])
+
+    @unittest.skipIf(find_spec('hdmf_zarr') is None, 'hdmf_zarr is not installed')
+    def test_zarr(self):
+        from hdmf_zarr.nwb import NWBZarrIO
+
+        write_ecp(os.path.join(self.data_dir, 'ecp.h5'), os.path.join(self.data_dir, 'electrodes.csv'))
+        zarr_path = os.path.join(self.tmp_dir, 'converted.nwb.zarr')
+        sonata2nwb(self.data_dir, zarr_path, buffer_gb=1e-6, n_jobs=2, backend='zarr')
+
+        with h5py.File(self.report_fpath, 'r') as h5:
+            expected = h5['report/cortex/data'][:]
+        with NWBZarrIO(zarr_path, 'r') as io:
+            cs = io.read().acquisition['membrane_potential']
+            np.testing.assert_array_equal(cs.data[:], expected)
+            data, _, columns = cs.get_data(cells=[1, 3], time_range=(0., 0.005))
+            np.testing.assert_array_equal(data, expected[:50, columns])
+
+        export_dir = os.path.join(self.tmp_dir, 'exported')
+        nwb2sonata(zarr_path, export_dir)
+        with h5py.File(os.path.join(export_dir, 'membrane_potential.h5'), 'r') as h5:
+            np.testing.assert_array_equal(h5['report/cortex/data'][:], expected)
+
+        with self.assertRaises(ValueError):
+            sonata2nwb(self.data_dir, zarr_path, backend='zarr', summary=True)
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+from pynwb import NWBFile, NWBHDF5IO
+
+
+def run(code):
+    """Run code in a fresh interpreter with the same sys.path and return what it printed"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                          env=env).stdout.decode().strip()
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_import_is_lazy(self):
+        heavy = ['pynwb', 'hdmf', 'h5py', 'pandas', 'tqdm', 'numpy']
+        loaded = run('import sys, ndx_simulation_output, ndx_simulation_output.io; '
+                     'print(sorted(m for m in {} if m in sys.modules))'.format(heavy))
+        self.assertEqual(loaded, '[]')
+
+    def test_classes_on_first_use(self):
+        out = run('import sys, ndx_simulation_output; '
+                  'from ndx_simulation_output import CompartmentSeries; '
+                  'from ndx_simulation_output.io import sonata2nwb; '
+                  'print(hasattr(CompartmentSeries, "find_compartments"), callable(sonata2nwb))')
+        self.assertEqual(out, 'True True')
+
+    def test_read_after_bare_import(self):
+        from ndx_simulation_output import Compartments, CompartmentSeries, SimulationMetaData
+
+        compartments = Compartments.from_csr(number=[0, 1, 0], index_pointer=[0, 2, 3])
+        nwbfile = NWBFile('description', 'id', datetime.now().astimezone())
+        nwbfile.add_lab_meta_data(SimulationMetaData(compartments=compartments))
+        nwbfile.add_acquisition(CompartmentSeries(name='membrane_potential', data=[[0., 1., 2.]],
+                                                  compartments=compartments, unit='V', rate=100.))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'test_read_after_bare_import.nwb')
+            with NWBHDF5IO(filename, 'w') as io:
+                io.write(nwbfile)
+
+            read = ('with NWBHDF5IO({!r}, "r") as io: '
+                    'print(io.read().acquisition["membrane_potential"].find_compartments(0, 1))').format(filename)
+            # pynwb imported after, or before the extension
+            for imports in ('import ndx_simulation_output; from pynwb import NWBHDF5IO',
+                            'from pynwb import NWBHDF5IO; import ndx_simulation_output'):
+                self.assertEqual(run('{}\n{}'.format(imports, read)), '[1]')
+
+    def test_pynwb_from_another_finder(self):
+        # pynwb found by a finder ahead of the path finder, as for editable installs
+        out = run('import sys\n'
+                  'from importlib.machinery import PathFinder\n'
+                  'class Finder(object):\n'
+                  '    def find_spec(self, fullname, path=None, target=None):\n'
+                  '        if fullname == "pynwb":\n'
+                  '            print("found")\n'
+                  '            return PathFinder.find_spec(fullname, path)\n'
+                  'sys.meta_path.insert(0, Finder())\n'
+                  'import ndx_simulation_output\n'
+                  'from pynwb import get_class\n'
+                  'print(hasattr(get_class("CompartmentSeries", "ndx-simulation-output"), "find_compartments"))')
+        self.assertEqual(out.split(), ['found', 'True'])
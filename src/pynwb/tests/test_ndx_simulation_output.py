@@ -3,7 +3,7 @@ import numpy as np
 import unittest
 from datetime import datetime
 from pynwb import NWBHDF5IO, NWBFile
-from ndx_simulation_output import SimulationMetaData, CompartmentSeries, Compartments
+from ndx_simulation_output import SimulationMetaData, CompartmentSeries, Compartments, create_ragged_array
 
 
 class CompartmentsTest(unittest.TestCase):
@@ -36,3 +36,138 @@ class CompartmentsTest(unittest.TestCase):
         assert(all(cs.find_compartments(1) == 5))
 
         os.remove(filename)
+
+    def test_compartments_from_csr(self):
+        compartments = Compartments.from_csr(number=[0, 1, 2, 3, 4, 0], index_pointer=[0, 5, 6],
+                                             position=[0.1, 0.2, 0.3, 0.4, 0.5, np.nan], id=[10, 20])
+
+        self.assertEqual(list(compartments.id.data), [10, 20])
+        self.assertEqual(list(compartments['number'][0]), [0, 1, 2, 3, 4])
+        self.assertEqual(list(compartments['number'][1]), [0])
+        np.testing.assert_array_equal(compartments['position'][0], [0.1, 0.2, 0.3, 0.4, 0.5])
+
+    def test_find_compartments_batch(self):
+        compartments = Compartments()
+        compartments.add_row(number=[0, 1, 2, 2], position=[0.1, 0.2, 0.3, 0.4], label=['soma', 'dend', 'axon', 'axon'])
+        compartments.add_row(number=[0], position=[0.5], label=['soma'])
+        compartments.add_row(number=[3, 0], position=[0.5, 0.5], label=['dend', 'soma'])
+        cs = CompartmentSeries(name='membrane_potential', data=np.random.randn(10, 7), compartments=compartments,
+                               unit='V', rate=100.)
+
+        np.testing.assert_array_equal(cs.find_compartments_batch([0, 1, 2], 0), [0, 4, 6])
+        np.testing.assert_array_equal(cs.find_compartments_batch([0, 2], [2, 3]), [2, 3, 5])
+        np.testing.assert_array_equal(cs.find_compartments_batch([0, 1, 2], compartment_labels='soma'), [0, 4, 6])
+        np.testing.assert_array_equal(cs.find_compartments_batch([2, 0], compartment_labels=['dend', 'other']), [5])
+        np.testing.assert_array_equal(cs.find_compartments_batch([2, 0]), [5, 6, 0, 1, 2, 3])
+
+        # the pairs behind the columns, where cell 1 has no compartment 2 and cell 0 two of them
+        columns, pairs = cs.find_compartments_batch([0, 1, 2], [2, 2, 3], return_pairs=True)
+        np.testing.assert_array_equal(columns, [2, 3, 5])
+        np.testing.assert_array_equal(pairs, [0, 0, 2])
+        columns, pairs = cs.find_compartments_batch([2, 1, 0], compartment_labels=['dend', 'other', 'soma'],
+                                                    return_pairs=True)
+        np.testing.assert_array_equal(columns, [5, 0])
+        np.testing.assert_array_equal(pairs, [0, 2])
+        columns, pairs = cs.find_compartments_batch([2, 1], return_pairs=True)
+        np.testing.assert_array_equal(pairs, [0, 0, 1])
+
+    def test_csr_cache(self):
+        compartments = Compartments()
+        compartments.add_row(number=[0, 1, 2], position=[0.1, 0.2, 0.3])
+        cs = CompartmentSeries(name='membrane_potential', data=np.random.randn(10, 4), compartments=compartments,
+                               unit='V', rate=100.)
+
+        csr = compartments.get_csr()
+        self.assertIs(compartments.get_csr(), csr)
+        self.assertFalse(csr['number'].flags.writeable)
+        np.testing.assert_array_equal(cs.find_compartments_batch([0], 2), [2])
+
+        compartments.add_row(number=[2], position=[0.5])
+        np.testing.assert_array_equal(compartments.get_csr()['offsets'], [0, 3, 4])
+        np.testing.assert_array_equal(cs.find_compartments_batch([0, 1], 2), [2, 3])
+        np.testing.assert_array_equal(cs.find_compartments(1, 2), [3])
+        self.assertEqual(len(cs.find_compartments(1, [])), 0)
+
+        compartments.clear_cache()
+        self.assertIsNot(compartments.get_csr(), csr)
+
+    def test_label_codes(self):
+        compartments = Compartments(label_names=[])
+        compartments.add_row(number=[0, 1], position=[0.1, 0.2], label=['soma', 'dend'])
+        compartments.add_row(number=[0], position=[0.5], label=['soma'])
+        self.assertNotIn('label', compartments.colnames)
+
+        self.nwbfile.add_lab_meta_data(SimulationMetaData(compartments=compartments))
+        self.nwbfile.add_acquisition(CompartmentSeries(name='membrane_potential', data=np.random.randn(10, 3),
+                                                       compartments=compartments, unit='V', rate=100.))
+
+        filename = 'test_label_codes.nwb'
+        with NWBHDF5IO(filename, 'w') as io:
+            io.write(self.nwbfile)
+
+        with NWBHDF5IO(filename, mode='r') as io:
+            cs = io.read().acquisition['membrane_potential']
+            self.assertEqual(list(cs.compartments.label_names[:]), ['soma', 'dend'])
+            np.testing.assert_array_equal(cs.compartments['label_code'].target.data[:], [0, 1, 0])
+            np.testing.assert_array_equal(cs.find_compartments_batch([0, 1], compartment_labels='soma'), [0, 2])
+            np.testing.assert_array_equal(cs.find_compartments(0, compartment_labels='dend'), [1])
+            np.testing.assert_array_equal(cs.find_compartments(0, compartment_labels=['dend', 'soma', 'other']), [1, 0])
+            self.assertEqual(len(cs.find_compartments(0, compartment_labels=[])), 0)
+            self.assertNotIn('label', cs.compartments.get_csr())
+
+        os.remove(filename)
+
+    def test_compartments_from_csr_labels(self):
+        compartments = Compartments.from_csr(number=[0, 1, 0], index_pointer=[0, 2, 3], label=['soma', 'dend', 'soma'])
+
+        self.assertEqual(compartments.label_names, ['dend', 'soma'])
+        csr = compartments.get_csr()
+        self.assertNotIn('label', csr)
+        np.testing.assert_array_equal(csr['label_names'][csr['label_code']], ['soma', 'dend', 'soma'])
+
+    def test_get_data(self):
+        compartments = Compartments.from_csr(number=np.tile(np.arange(4), 30), index_pointer=np.arange(0, 121, 4))
+        data = np.random.randn(1000, 120)
+        self.nwbfile.add_lab_meta_data(SimulationMetaData(compartments=compartments))
+        self.nwbfile.add_acquisition(CompartmentSeries(name='membrane_potential', data=data, compartments=compartments,
+                                                       unit='V', rate=100., starting_time=0.5))
+
+        filename = 'test_get_data.nwb'
+        with NWBHDF5IO(filename, 'w') as io:
+            io.write(self.nwbfile)
+
+        with NWBHDF5IO(filename, mode='r') as io:
+            cs = io.read().acquisition['membrane_potential']
+
+            window, timestamps, columns = cs.get_data(cells=range(10, 21), compartments=0, time_range=(1.0, 1.5))
+            np.testing.assert_array_equal(columns, np.arange(40, 81, 4))
+            np.testing.assert_allclose(timestamps, np.arange(50, 100) / 100. + 0.5)
+            np.testing.assert_array_equal(window, data[50:100, columns])
+
+            window, timestamps, columns = cs.get_data(cells=[5, 3])
+            np.testing.assert_array_equal(columns, [20, 21, 22, 23, 12, 13, 14, 15])
+            np.testing.assert_array_equal(window, data[:, columns])
+
+            # the compartments are selected of every cell, like in find_compartments
+            window, timestamps, columns = cs.get_data(cells=[0, 1], compartments=[0, 2])
+            np.testing.assert_array_equal(columns, [0, 2, 4, 6])
+            np.testing.assert_array_equal(window, data[:, columns])
+            _, _, columns = cs.get_data(compartments=[0, 2])
+            np.testing.assert_array_equal(columns, np.sort(np.r_[np.arange(0, 120, 4), np.arange(2, 120, 4)]))
+
+        os.remove(filename)
+
+    def test_create_ragged_array(self):
+        values = [[1, 2], [], [3, 4, 5]]
+        for kwargs in ({'values': values},
+                       {'values': (np.array(row) for row in values)},
+                       {'values': [1, 2, 3, 4, 5], 'lengths': [2, 0, 3]},
+                       {'values': np.array([1, 2, 3, 4, 5]), 'offsets': [2, 2, 5]}):
+            data, index = create_ragged_array('number', dtype=int, **kwargs)
+            np.testing.assert_array_equal(data.data, [1, 2, 3, 4, 5])
+            np.testing.assert_array_equal(index.data, [2, 2, 5])
+            self.assertEqual(data.data.dtype, np.dtype(int))
+            np.testing.assert_array_equal(index[2], [3, 4, 5])
+
+        with self.assertRaises(ValueError):
+            create_ragged_array('number', [1, 2, 3], lengths=[2, 2])
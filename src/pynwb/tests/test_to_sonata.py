@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+from pynwb import NWBHDF5IO
+from ndx_simulation_output.io.from_sonata import sonata2nwb
+from ndx_simulation_output.io.to_sonata import export_spikes, write_blocks
+
+from ndx_simulation_output.testing import write_spikes
+
+
+class SonataExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spikes_fpath = os.path.join(self.tmp_dir, 'spikes.h5')
+        write_spikes(self.spikes_fpath)
+        self.nwb_fpath = os.path.join(self.tmp_dir, 'converted.nwb')
+        sonata2nwb(self.spikes_fpath, self.nwb_fpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_export_spikes(self):
+        with h5py.File(self.spikes_fpath, 'r') as h5:
+            node_ids = h5['spikes/cortex/node_ids'][:]
+            timestamps = h5['spikes/cortex/timestamps'][:]
+
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            units = io.read().units
+            for sorting in ('by_time', 'by_id', 'none'):
+                export_spikes(units, self.tmp_dir, save_fname=sorting + '.h5', sorting=sorting)
+
+        with h5py.File(os.path.join(self.tmp_dir, 'by_time.h5'), 'r') as h5:
+            np.testing.assert_array_equal(h5['spikes/internal/node_ids'][:], node_ids)
+            np.testing.assert_array_equal(h5['spikes/internal/timestamps'][:], timestamps)
+        for sorting in ('by_id', 'none'):
+            with h5py.File(os.path.join(self.tmp_dir, sorting + '.h5'), 'r') as h5:
+                self.assertEqual(h5['spikes/internal'].attrs['sorting'], sorting)
+                self.assertTrue(np.all(np.diff(h5['spikes/internal/node_ids'][:].astype(int)) >= 0))
+
+    def test_export_spikes_bad_sorting(self):
+        with NWBHDF5IO(self.nwb_fpath, 'r') as io:
+            with self.assertRaises(ValueError):
+                export_spikes(io.read().units, self.tmp_dir, sorting='by_name')
+
+    def test_write_blocks(self):
+        data = np.random.randn(105, 4)
+        with h5py.File(os.path.join(self.tmp_dir, 'blocks.h5'), 'w') as h5:
+            dset = write_blocks(h5, 'data', data, 'float32', buffer_gb=1e-7, scale=1000, compression='gzip')
+            self.assertEqual(dset.compression, 'gzip')
+            np.testing.assert_allclose(dset[:], data * 1000, rtol=1e-6)
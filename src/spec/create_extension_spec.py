@@ -10,7 +10,7 @@ def main():
     ns_builder = NWBNamespaceBuilder(doc='Data types for recording data from multiple compartments of multiple '
                                          'neurons in a single TimeSeries.',
                                      name='ndx-simulation-output',
-                                     version='0.2.6',
+                                     version='0.3.0',
                                      author='Ben Dichter',
                                      contact='ben.dichter@gmail.com')
 
@@ -48,6 +48,21 @@ def main():
                              neurodata_type_inc='VectorIndex',
                              doc='indexes label',
                              quantity='?')
+    Compartments.add_dataset(name='label_code',
+                             neurodata_type_inc='VectorData',
+                             dtype='int',
+                             doc='Labels for compartments, stored as integer codes that index into label_names.',
+                             quantity='?')
+    Compartments.add_dataset(name='label_code_index',
+                             neurodata_type_inc='VectorIndex',
+                             doc='Index for label_code.',
+                             quantity='?')
+    Compartments.add_dataset(name='label_names',
+                             dtype='text',
+                             shape=(None,),
+                             dims=('num_labels',),
+                             doc='Names of the labels encoded by label_code.',
+                             quantity='?')
 
     CompartmentsSeries = NWBGroupSpec(neurodata_type_def='CompartmentSeries',
                                       neurodata_type_inc='TimeSeries',
@@ -57,15 +72,38 @@ def main():
                                 quantity='?',
                                 doc='Metadata about compartments in this CompartmentSeries.')
 
+    DownsampledCompartmentSeries = NWBGroupSpec(
+        neurodata_type_def='DownsampledCompartmentSeries',
+        neurodata_type_inc='TimeSeries',
+        doc='Envelope of a CompartmentSeries at a reduced rate, for plotting long recordings without reading the '
+            'full-rate data. data holds the mean of each window of decimation samples of the source.')
+    DownsampledCompartmentSeries.add_attribute(name='decimation',
+                                               dtype='int',
+                                               doc='Number of samples of the source in each sample of this series.')
+    DownsampledCompartmentSeries.add_dataset(name='min',
+                                             dtype='numeric',
+                                             shape=(None, None),
+                                             dims=('num_times', 'num_compartments'),
+                                             doc='Minimum of each window of decimation samples of the source.')
+    DownsampledCompartmentSeries.add_dataset(name='max',
+                                             dtype='numeric',
+                                             shape=(None, None),
+                                             dims=('num_times', 'num_compartments'),
+                                             doc='Maximum of each window of decimation samples of the source.')
+    DownsampledCompartmentSeries.add_link(name='source',
+                                          target_type='CompartmentSeries',
+                                          doc='The full-rate CompartmentSeries that this series is an envelope of.')
+
     SimulationMetaData = NWBGroupSpec(name='simulation',
                                       neurodata_type_def='SimulationMetaData',
                                       neurodata_type_inc='LabMetaData',
                                       doc='Group that holds metadata for simulations.')
-    SimulationMetaData.add_group(name='compartments',
-                                 neurodata_type_inc='Compartments',
-                                 doc='Table that holds information about what places are being recorded.')
+    SimulationMetaData.add_group(neurodata_type_inc='Compartments',
+                                 quantity='+',
+                                 doc='Tables that hold information about what places are being recorded, one per node '
+                                     'population. The table of a single population is named compartments.')
 
-    new_data_types = [Compartments, CompartmentsSeries, SimulationMetaData]
+    new_data_types = [Compartments, CompartmentsSeries, DownsampledCompartmentSeries, SimulationMetaData]
 
     # export the spec to yaml files in the spec folder
     output_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'spec'))